@@ -1,11 +1,20 @@
 import wx
-import socket
 import threading
 import os
-import struct
 import time
-import ssl
+import collections
 import configparser
+import itertools
+import multiprocessing
+
+from event_bus import EventBus
+from server_engine import ServerEngine
+from server_pool import ServerPool
+from transfer_client import TransferClient
+from transfer_queue import CANCELLED, DONE, FAILED, QUEUED, RETRYING, RUNNING, TransferManager
+
+# Logs and transfer updates reach the widgets in batches this often (milliseconds).
+UI_REFRESH_MS = 100
 
 
 # --- Drag and Drop Class ---
@@ -16,9 +25,8 @@ class FileDropTarget(wx.FileDropTarget):
 
     def OnDropFiles(self, x, y, filenames):
         if self.window.upload_btn.IsEnabled() and filenames:
-            filepath = filenames[0]
-            self.window.log_client(f"File dropped: {os.path.basename(filepath)}. Starting upload.", 'info')
-            threading.Thread(target=self.window.upload_file_worker, args=(filepath,), daemon=True).start()
+            self.window.log_client(f"{len(filenames)} item(s) dropped, queued for upload.", 'info')
+            self.window.transfers.upload(filenames)
             return True
         return False
 
@@ -41,9 +49,11 @@ class FileTransferApp(wx.Frame):
             }
         }
 
-        self.server_socket = None;
-        self.server_thread = None;
+        self.server_engine = None;
         self.is_server_running = False
+        self.transfer_client = None;
+        self.transfer_client_key = None;
+        self.transfer_client_lock = threading.Lock()
         self.buffer_size = 8192;
         self.server_uploads_dir = "server_uploads";
         self.client_downloads_dir = "client_downloads"
@@ -55,10 +65,24 @@ class FileTransferApp(wx.Frame):
         self.CreateStatusBar()
         self.config = self.load_config()
         self.mode = self.config.get('UI', 'mode', fallback='dark')
+        # Log and transfer events from the server and worker threads, drained by ui_timer.
+        self.events = EventBus(self.config.getint('UI', 'log_lines', fallback=1000))
 
         self.create_gui()
         self.apply_theme()
         self.Center()
+        # channel -> (log view, the lines it should show, how many it holds now)
+        self.log_views = {'server': [self.server_status, collections.deque(maxlen=self.events.max_lines), 0],
+                          'client': [self.client_status, collections.deque(maxlen=self.events.max_lines), 0]}
+        self.transfers = TransferManager(
+            self.get_transfer_client, self.client_downloads_dir,
+            concurrency=self.config.getint('Client', 'concurrency', fallback=3),
+            retries=self.config.getint('Client', 'retries', fallback=2),
+            on_update=self._on_transfer_event, progress_interval=UI_REFRESH_MS / 1000)
+        self.transfer_rows = []  # TransferItem ids, one per row of transfer_list
+        self.ui_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_ui_tick, self.ui_timer)
+        self.ui_timer.Start(UI_REFRESH_MS)
         self.Bind(wx.EVT_CLOSE, self.on_close)
 
     def load_config(self):
@@ -86,7 +110,7 @@ class FileTransferApp(wx.Frame):
         for widget in self.panel.GetChildren():
             if isinstance(widget, (wx.CheckBox, wx.StaticText)):
                 widget.SetForegroundColour(theme['TEXT_COLOR'])
-            if isinstance(widget, (wx.TextCtrl, wx.ListBox)):
+            if isinstance(widget, (wx.TextCtrl, wx.ListBox, wx.ListCtrl)):
                 widget.SetBackgroundColour(theme['INPUT_BG_COLOR']);
                 widget.SetForegroundColour(theme['TEXT_COLOR'])
             if isinstance(widget, wx.StaticBox):
@@ -160,14 +184,15 @@ class FileTransferApp(wx.Frame):
         connection_sizer.Add(self.use_ssl_client, 0, wx.ALL | wx.CENTER, 0);
         client_sizer.Add(connection_sizer, 0, wx.EXPAND | wx.ALL, 5)
         upload_sizer = wx.BoxSizer(wx.HORIZONTAL)
-        self.upload_btn = wx.Button(self.panel, label="Upload File to Server");
-        self.upload_btn.SetToolTip("Select a local file or drag-drop one.")
+        self.upload_btn = wx.Button(self.panel, label="Upload Files to Server");
+        self.upload_btn.SetToolTip("Select local files or drag-drop files and folders.")
         self.upload_btn.Bind(wx.EVT_BUTTON, self.on_upload_file);
         upload_sizer.Add(self.upload_btn, 1, wx.EXPAND | wx.ALL, 5)
         client_sizer.Add(upload_sizer, 0, wx.EXPAND)
         download_box = wx.StaticBox(self.panel, label="Download from Server")
         download_sizer = wx.StaticBoxSizer(download_box, wx.VERTICAL)
-        self.remote_files = wx.ListBox(self.panel, style=wx.LB_SINGLE)
+        self.remote_files = wx.ListBox(self.panel, style=wx.LB_EXTENDED)
+        self.remote_files.Bind(wx.EVT_LISTBOX, self.on_remote_file_selected)
         download_sizer.Add(self.remote_files, 1, wx.EXPAND | wx.ALL, 5)
         download_buttons_sizer = wx.BoxSizer(wx.HORIZONTAL)
         self.refresh_btn = wx.Button(self.panel, label="Refresh List");
@@ -175,11 +200,32 @@ class FileTransferApp(wx.Frame):
         self.refresh_btn.Bind(wx.EVT_BUTTON, self.on_refresh_list);
         download_buttons_sizer.Add(self.refresh_btn, 1, wx.EXPAND | wx.ALL, 5)
         self.download_btn = wx.Button(self.panel, label="Download Selected");
-        self.download_btn.SetToolTip("Download the file currently selected.")
+        self.download_btn.SetToolTip("Download the selected files (Ctrl/Shift-click to select several).")
         self.download_btn.Bind(wx.EVT_BUTTON, self.on_download_file);
         download_buttons_sizer.Add(self.download_btn, 1, wx.EXPAND | wx.ALL, 5)
         download_sizer.Add(download_buttons_sizer, 0, wx.EXPAND);
         client_sizer.Add(download_sizer, 1, wx.EXPAND | wx.ALL, 5)
+        transfers_box = wx.StaticBox(self.panel, label="Transfers")
+        transfers_sizer = wx.StaticBoxSizer(transfers_box, wx.VERTICAL)
+        self.transfer_list = wx.ListCtrl(self.panel, style=wx.LC_REPORT)
+        for col, (heading, width) in enumerate((("File", 200), ("Direction", 75), ("Status", 160),
+                                                ("Progress", 120), ("Speed", 90))):
+            self.transfer_list.InsertColumn(col, heading, width=width)
+        transfers_sizer.Add(self.transfer_list, 1, wx.EXPAND | wx.ALL, 5)
+        transfer_buttons_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        self.cancel_btn = wx.Button(self.panel, label="Cancel");
+        self.cancel_btn.SetToolTip("Cancel the selected transfers.")
+        self.cancel_btn.Bind(wx.EVT_BUTTON, self.on_cancel_transfers);
+        transfer_buttons_sizer.Add(self.cancel_btn, 1, wx.EXPAND | wx.ALL, 5)
+        self.retry_btn = wx.Button(self.panel, label="Retry");
+        self.retry_btn.SetToolTip("Queue the selected failed or cancelled transfers again.")
+        self.retry_btn.Bind(wx.EVT_BUTTON, self.on_retry_transfers);
+        transfer_buttons_sizer.Add(self.retry_btn, 1, wx.EXPAND | wx.ALL, 5)
+        self.clear_btn = wx.Button(self.panel, label="Clear Finished");
+        self.clear_btn.Bind(wx.EVT_BUTTON, self.on_clear_transfers);
+        transfer_buttons_sizer.Add(self.clear_btn, 1, wx.EXPAND | wx.ALL, 5)
+        transfers_sizer.Add(transfer_buttons_sizer, 0, wx.EXPAND);
+        client_sizer.Add(transfers_sizer, 1, wx.EXPAND | wx.ALL, 5)
         self.progress_bar = wx.Gauge(self.panel, range=100, style=wx.GA_HORIZONTAL);
         self.progress_bar.Hide()
         client_sizer.Add(self.progress_bar, 0, wx.ALL | wx.EXPAND, 5)
@@ -200,21 +246,38 @@ class FileTransferApp(wx.Frame):
 
     # --- MISSING METHODS RE-ADDED HERE ---
     def log_server(self, message, log_type='info'):
-        wx.CallAfter(self._append_to_textctrl, self.server_status, message, log_type)
+        self.events.log('server', message, log_type)
 
     def log_client(self, message, log_type='info'):
-        wx.CallAfter(self._append_to_textctrl, self.client_status, message, log_type)
-
-    def _append_to_textctrl(self, textctrl, message, log_type):
-        theme = self.themes[self.mode]
-        color_map = {'info': theme['INFO_COLOR'], 'success': theme['SUCCESS_COLOR'], 'error': theme['ERROR_COLOR']}
-        color = color_map.get(log_type, theme['TEXT_COLOR'])
-        timestamp = f"[{time.strftime('%H:%M:%S')}] "
-        textctrl.SetDefaultStyle(wx.TextAttr(theme['TEXT_COLOR']))
-        textctrl.AppendText(timestamp)
-        textctrl.SetDefaultStyle(wx.TextAttr(color))
-        textctrl.AppendText(f"{message}\n")
-        textctrl.SetDefaultStyle(wx.TextAttr(theme['TEXT_COLOR']))
+        self.events.log('client', message, log_type)
+
+    def on_ui_tick(self, e):
+        logs, updates = self.events.drain()
+        for channel, (lines, dropped) in logs.items(): self._show_log_lines(channel, lines, dropped)
+        for item, state, error in updates: self._on_transfer_update(item, state, error)
+        if updates: self._update_transfer_summary()
+
+    def _show_log_lines(self, channel, lines, dropped):
+        # The views are ring buffers: once one holds a quarter more lines than it should,
+        # it is rewritten from the lines it keeps, so memory stays flat however long it runs.
+        view = self.log_views[channel]
+        textctrl, history, shown = view
+        if dropped: lines = [(lines[0][0], f"... {dropped} earlier message(s) not shown", 'info')] + lines
+        history.extend(lines)
+        textctrl.Freeze()
+        try:
+            if shown + len(lines) > history.maxlen * 5 // 4:
+                textctrl.Clear()
+                lines, shown = list(history), 0
+            theme = self.themes[self.mode]
+            color_map = {'info': theme['INFO_COLOR'], 'success': theme['SUCCESS_COLOR'], 'error': theme['ERROR_COLOR']}
+            # One style change and one append per run of lines of the same type.
+            for log_type, run in itertools.groupby(lines, key=lambda line: line[2]):
+                textctrl.SetDefaultStyle(wx.TextAttr(color_map.get(log_type, theme['TEXT_COLOR'])))
+                textctrl.AppendText(''.join(f"[{stamp}] {message}\n" for stamp, message, _ in run))
+            view[2] = shown + len(lines)
+        finally:
+            textctrl.Thaw()
 
     # --- Rest of the methods are unchanged ---
     def format_speed(self, s):
@@ -225,6 +288,16 @@ class FileTransferApp(wx.Frame):
         else:
             return f"{s / 1024 ** 2:.2f} MB/s"
 
+    def format_size(self, s):
+        if s < 1024:
+            return f"{s} B"
+        elif s < 1024 ** 2:
+            return f"{s / 1024:.2f} KB"
+        elif s < 1024 ** 3:
+            return f"{s / 1024 ** 2:.2f} MB"
+        else:
+            return f"{s / 1024 ** 3:.2f} GB"
+
     def format_eta(self, s):
         if s < 60:
             return f"{int(s)}s"
@@ -233,9 +306,6 @@ class FileTransferApp(wx.Frame):
         else:
             return f"{int(s // 3600)}h {int((s % 3600) // 60)}m"
 
-    def update_progress(self, v, s=True):
-        wx.CallAfter(self._update_progress_ui, v, s)
-
     def _update_progress_ui(self, v, s):
         if s: self.progress_bar.SetValue(v);
         if s and not self.progress_bar.IsShown():
@@ -243,6 +313,71 @@ class FileTransferApp(wx.Frame):
         elif not s and self.progress_bar.IsShown():
             self.progress_bar.Hide(); self.Layout()
 
+    # --- Transfer queue ---
+    def _transfer_columns(self, item, state, error):
+        status = {QUEUED: "Queued", RUNNING: f"Running (attempt {item.attempts})" if item.attempts > 1 else "Running",
+                  RETRYING: f"Retrying: {error}", DONE: "Done", FAILED: f"Failed: {error}",
+                  CANCELLED: "Cancelled"}[state]
+        progress = f"{int(item.done / item.total * 100)}% of {self.format_size(item.total)}" if item.total else ""
+        speed = self.format_speed(item.rate) if state == RUNNING else ""
+        return [item.label, "Download" if item.is_download else "Upload", status, progress, speed]
+
+    def _on_transfer_event(self, item):
+        # Worker threads: outcomes are logged as they happen, while the list row only gets
+        # the latest state when the next frame is drawn.
+        state, error = item.state, item.error
+        self.events.update(('transfer', item.id), (item, state, error))
+        verb = "Download" if item.is_download else "Upload"
+        if state == DONE:
+            self.log_client(f"{verb} successful: {item.label}", 'success')
+        elif state == FAILED:
+            self.log_client(f"{verb} failed for {item.label}: {error}", 'error')
+        elif state == RETRYING:
+            self.log_client(f"{verb} of {item.label} interrupted ({error}), retrying.", 'error')
+
+    def _on_transfer_update(self, item, state, error):
+        # `state` and `error` are as of the update; `item` itself may have moved on since.
+        if item.id not in self.transfers.items: return  # cleared
+        if item.id not in self.transfer_rows:
+            self.transfer_rows.append(item.id)
+            self.transfer_list.Append([item.label, "", "", "", ""])
+        row = self.transfer_rows.index(item.id)
+        for col, text in enumerate(self._transfer_columns(item, state, error)):
+            self.transfer_list.SetItem(row, col, text)
+
+    def _update_transfer_summary(self):
+        items = list(self.transfers.items.values())
+        active = [i for i in items if i.state in (RUNNING, RETRYING)]
+        queued = sum(1 for i in items if i.state == QUEUED)
+        total, done = sum(i.total for i in active), sum(i.done for i in active)
+        self._update_progress_ui(int(done / total * 100) if total else 0, bool(active))
+        if active or queued:
+            spd = sum(i.rate for i in active)
+            eta = (total - done) / spd if spd > 0 else 0
+            self.SetStatusText(f"{len(active)} transferring, {queued} queued at {self.format_speed(spd)} | "
+                               f"ETA: {self.format_eta(eta)}")
+        else:
+            self.SetStatusText("All transfers finished.")
+
+    def _selected_transfers(self):
+        rows, row = [], self.transfer_list.GetFirstSelected()
+        while row != -1:
+            rows.append(self.transfer_rows[row])
+            row = self.transfer_list.GetNextSelected(row)
+        return rows
+
+    def on_cancel_transfers(self, e):
+        for item_id in self._selected_transfers(): self.transfers.cancel(item_id)
+
+    def on_retry_transfers(self, e):
+        for item_id in self._selected_transfers(): self.transfers.retry(item_id)
+
+    def on_clear_transfers(self, e):
+        for item_id in self.transfers.clear_finished():
+            row = self.transfer_rows.index(item_id)
+            self.transfer_list.DeleteItem(row)
+            del self.transfer_rows[row]
+
     def set_client_controls_enabled(self, e=True):
         self.upload_btn.Enable(e);
         self.download_btn.Enable(e);
@@ -263,88 +398,60 @@ class FileTransferApp(wx.Frame):
             use_ssl = self.use_ssl_server.GetValue()
             if use_ssl and (not os.path.exists('cert.pem') or not os.path.exists('key.pem')): self.log_server(
                 "cert.pem or key.pem not found.", 'error'); return
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM);
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind(('', port));
-            self.server_socket.listen(5);
+            options = dict(
+                use_ssl=use_ssl,
+                backlog=self.config.getint('Server', 'backlog', fallback=128),
+                max_connections=self.config.getint('Server', 'max_connections', fallback=256),
+                idle_timeout=self.config.getfloat('Server', 'idle_timeout', fallback=300.0),
+                rate_limit=self.config.getfloat('Server', 'rate_limit', fallback=0),
+                client_rate_limit=self.config.getfloat('Server', 'client_rate_limit', fallback=0),
+                metrics_file=self.config.get('Server', 'metrics_file', fallback='') or None,
+                metrics_interval=self.config.getfloat('Server', 'metrics_interval', fallback=15.0),
+                cache_size=self.config.getint('Server', 'cache_size', fallback=256 * 1024 * 1024),
+                log=self.log_server)
+            workers = self.config.getint('Server', 'workers', fallback=1)
+            if workers > 1:
+                self.server_engine = ServerPool(workers, port, self.server_uploads_dir, **options)
+            else:
+                self.server_engine = ServerEngine(port, self.server_uploads_dir, **options)
+            self.server_engine.start()
             self.is_server_running = True;
             self.server_btn.SetLabel("Stop Server")
             self.server_port.Disable();
             self.use_ssl_server.Disable();
             self.log_server(f"Server started on port {port} (SSL: {'On' if use_ssl else 'Off'})...", 'success')
-            self.server_thread = threading.Thread(target=self.server_worker, args=(use_ssl,), daemon=True);
-            self.server_thread.start()
         except Exception as e:
+            self.server_engine = None
             self.log_server(f"Error starting server: {e}", 'error')
 
     def stop_server(self):
         self.is_server_running = False
-        if self.server_socket: self.server_socket.close(); self.server_socket = None
+        if self.server_engine: self.server_engine.stop(); self.server_engine = None
         self.server_btn.SetLabel("Start Server");
         self.server_port.Enable();
         self.use_ssl_server.Enable();
         self.log_server("Server stopped.", 'info')
 
-    def server_worker(self, use_ssl):
-        ssl_context = None
-        if use_ssl: ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH); ssl_context.load_cert_chain(
-            'cert.pem', 'key.pem')
-        while self.is_server_running:
-            try:
-                conn, addr = self.server_socket.accept()
-                if use_ssl: conn = ssl_context.wrap_socket(conn, server_side=True)
-                client_thread = threading.Thread(target=self.handle_client, args=(conn, addr), daemon=True);
-                client_thread.start()
-            except (OSError, ssl.SSLError):
-                break
-
-    def handle_client(self, conn, addr):
-        try:
-            cmd = self.receive_exactly(conn, 4).decode('utf-8').strip()
-            if cmd == "UPLD":
-                self.handle_upload(conn)
-            elif cmd == "DNLD":
-                self.handle_download(conn)
-            elif cmd == "LIST":
-                self.handle_list(conn)
-        finally:
-            conn.close()
-
-    def handle_list(self, conn):
-        conn.sendall("\n".join(os.listdir(self.server_uploads_dir)).encode('utf-8'))
-
-    def handle_upload(self, conn):
-        try:
-            fn_len = struct.unpack('!I', self.receive_exactly(conn, 4))[0];
-            fn = self.receive_exactly(conn, fn_len).decode('utf-8')
-            fs = struct.unpack('!Q', self.receive_exactly(conn, 8))[0]
-            with open(os.path.join(self.server_uploads_dir, os.path.basename(fn)), 'wb') as f:
-                rec, tot = 0, fs
-                while rec < tot: c = self.receive_exactly(conn, min(self.buffer_size, tot - rec)); f.write(
-                    c); rec += len(c)
-            conn.sendall(b"OK")
-        except:
-            conn.sendall(b"ERROR")
-
-    def handle_download(self, conn):
-        try:
-            fn_len = struct.unpack('!I', self.receive_exactly(conn, 4))[0];
-            fn = self.receive_exactly(conn, fn_len).decode('utf-8')
-            fp = os.path.join(self.server_uploads_dir, os.path.basename(fn))
-            if not os.path.exists(fp): conn.sendall(struct.pack('!Q', 0)); return
-            fs = os.path.getsize(fp);
-            conn.sendall(struct.pack('!Q', fs))
-            with open(fp, 'rb') as f:
-                conn.sendfile(f)
-        except:
-            pass
-
-    def receive_exactly(self, sock, num_bytes):
-        d = bytearray(num_bytes);
-        mv = memoryview(d);
-        br = 0
-        while br < num_bytes: c = sock.recv_into(mv[br:], num_bytes - br); br += c
-        return d
+    def get_transfer_client(self):
+        # One pooled client per server address, so consecutive commands reuse the same sessions.
+        key = (self.client_ip.GetValue(), int(self.client_port.GetValue()), self.use_ssl_client.GetValue())
+        with self.transfer_client_lock:
+            if self.transfer_client_key != key:
+                if self.transfer_client: self.transfer_client.close()
+                self.transfer_client = TransferClient(
+                    *key, buffer_size=self.buffer_size,
+                    pool_size=self.config.getint('Client', 'pool_size', fallback=4),
+                    streams=self.config.getint('Client', 'streams', fallback=4),
+                    stripe_threshold=self.config.getint('Client', 'stripe_threshold', fallback=64 * 1024 * 1024),
+                    delta_sync=self.config.getboolean('Client', 'delta_sync', fallback=True),
+                    compression=self.config.getboolean('Client', 'compression', fallback=True))
+                self.transfer_client_key = key
+            return self.transfer_client
+
+    def on_remote_file_selected(self, e):
+        entry = self.transfer_client.remote_index.get(e.GetString()) if self.transfer_client else None
+        if entry: self.SetStatusText(f"{entry.name}: {self.format_size(entry.size)}, modified "
+                                     f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(entry.mtime))}")
 
     def on_refresh_list(self, e):
         threading.Thread(target=self.refresh_list_worker, daemon=True).start()
@@ -353,117 +460,36 @@ class FileTransferApp(wx.Frame):
         wx.CallAfter(self.set_client_controls_enabled, False);
         wx.CallAfter(self.SetStatusText, "Refreshing...")
         try:
-            ip, port, use_ssl = self.client_ip.GetValue(), int(
-                self.client_port.GetValue()), self.use_ssl_client.GetValue()
-            with socket.create_connection((ip, port)) as sock:
-                conn = sock
-                if use_ssl: context = ssl.create_default_context(); context.check_hostname = False; context.verify_mode = ssl.CERT_NONE; conn = context.wrap_socket(
-                    sock, server_hostname=ip)
-                conn.sendall(b'LIST');
-                file_list_str = conn.recv(4096).decode('utf-8');
-                files = file_list_str.split('\n')
-                wx.CallAfter(self.remote_files.Set, files);
-                self.log_client("List refreshed.", 'success');
-                wx.CallAfter(self.SetStatusText, "List refreshed.")
+            files = self.get_transfer_client().list_files()
+            wx.CallAfter(self.remote_files.Set, files);
+            self.log_client("List refreshed.", 'success');
+            wx.CallAfter(self.SetStatusText, "List refreshed.")
         except Exception as e:
             self.log_client(f"List refresh failed: {e}", 'error'); wx.CallAfter(self.SetStatusText, "Refresh failed.")
         finally:
             wx.CallAfter(self.set_client_controls_enabled, True)
 
     def on_upload_file(self, e):
-        with wx.FileDialog(self, "Choose file", style=wx.FD_OPEN) as dlg:
+        with wx.FileDialog(self, "Choose files", style=wx.FD_OPEN | wx.FD_MULTIPLE) as dlg:
             if dlg.ShowModal() == wx.ID_CANCEL: return
-            threading.Thread(target=self.upload_file_worker, args=(dlg.GetPath(),), daemon=True).start()
-
-    def upload_file_worker(self, fp):
-        wx.CallAfter(self.set_client_controls_enabled, False);
-        self.update_progress(0, True)
-        try:
-            ip, port, use_ssl = self.client_ip.GetValue(), int(
-                self.client_port.GetValue()), self.use_ssl_client.GetValue()
-            fn, fs = os.path.basename(fp), os.path.getsize(fp)
-            with socket.create_connection((ip, port)) as sock:
-                conn = sock
-                if use_ssl: context = ssl.create_default_context(); context.check_hostname = False; context.verify_mode = ssl.CERT_NONE; conn = context.wrap_socket(
-                    sock, server_hostname=ip)
-                conn.sendall(b'UPLD');
-                conn.sendall(struct.pack('!I', len(fn)) + fn.encode('utf-8'));
-                conn.sendall(struct.pack('!Q', fs))
-                with open(fp, 'rb') as f:
-                    sent, st, lut = 0, time.time(), time.time()
-                    while sent < fs:
-                        data = f.read(self.buffer_size);
-                        conn.sendall(data);
-                        sent += len(data);
-                        self.update_progress(int(sent / fs * 100))
-                        ct = time.time()
-                        if ct - lut > 0.25:
-                            et = ct - st;
-                            spd = sent / et if et > 0 else 0;
-                            eta = (fs - sent) / spd if spd > 0 else 0
-                            wx.CallAfter(self.SetStatusText,
-                                         f"Uploading at {self.format_speed(spd)} | ETA: {self.format_eta(eta)}")
-                            lut = ct
-                if conn.recv(2) == b"OK":
-                    self.log_client(f"Upload successful: {fn}", 'success'); wx.CallAfter(self.SetStatusText,
-                                                                                         "Upload complete.")
-                else:
-                    self.log_client(f"Upload failed for {fn}.", 'error'); wx.CallAfter(self.SetStatusText,
-                                                                                       "Upload failed.")
-        except Exception as e:
-            self.log_client(f"Upload error: {e}", 'error'); wx.CallAfter(self.SetStatusText, "Upload error.")
-        finally:
-            self.update_progress(0, False); wx.CallAfter(self.set_client_controls_enabled, True)
+            self.transfers.upload(dlg.GetPaths())
 
     def on_download_file(self, e):
-        sel = self.remote_files.GetSelection()
-        if sel == wx.NOT_FOUND: wx.MessageBox("Please select a file.", "No File Selected"); return
-        threading.Thread(target=self.download_file_worker, args=(self.remote_files.GetString(sel),),
-                         daemon=True).start()
-
-    def download_file_worker(self, fn):
-        wx.CallAfter(self.set_client_controls_enabled, False);
-        self.update_progress(0, True)
-        try:
-            ip, port, use_ssl = self.client_ip.GetValue(), int(
-                self.client_port.GetValue()), self.use_ssl_client.GetValue()
-            with socket.create_connection((ip, port)) as sock:
-                conn = sock
-                if use_ssl: context = ssl.create_default_context(); context.check_hostname = False; context.verify_mode = ssl.CERT_NONE; conn = context.wrap_socket(
-                    sock, server_hostname=ip)
-                conn.sendall(b'DNLD');
-                conn.sendall(struct.pack('!I', len(fn)) + fn.encode('utf-8'))
-                fs = struct.unpack('!Q', self.receive_exactly(conn, 8))[0]
-                if fs == 0: self.log_client(f"File not found: {fn}", 'error'); wx.CallAfter(self.SetStatusText,
-                                                                                            "File not found."); return
-                fp = os.path.join(self.client_downloads_dir, fn)
-                with open(fp, 'wb') as f:
-                    rec, st, lut = 0, time.time(), time.time()
-                    while rec < fs:
-                        c = self.receive_exactly(conn, min(self.buffer_size, fs - rec));
-                        f.write(c);
-                        rec += len(c);
-                        self.update_progress(int(rec / fs * 100))
-                        ct = time.time()
-                        if ct - lut > 0.25:
-                            et = ct - st;
-                            spd = rec / et if et > 0 else 0;
-                            eta = (fs - rec) / spd if spd > 0 else 0
-                            wx.CallAfter(self.SetStatusText,
-                                         f"Downloading at {self.format_speed(spd)} | ETA: {self.format_eta(eta)}");
-                            lut = ct
-                self.log_client(f"Download successful: {fn}", 'success');
-                wx.CallAfter(self.SetStatusText, "Download complete.")
-        except Exception as e:
-            self.log_client(f"Download error: {e}", 'error'); wx.CallAfter(self.SetStatusText, "Download error.")
-        finally:
-            self.update_progress(0, False); wx.CallAfter(self.set_client_controls_enabled, True)
+        names = [self.remote_files.GetString(sel) for sel in self.remote_files.GetSelections()]
+        if not names: wx.MessageBox("Please select a file.", "No File Selected"); return
+        index = self.transfer_client.remote_index if self.transfer_client else {}
+        self.transfers.download(names, {name: index[name].size for name in names if name in index})
 
     def on_close(self, e):
+        self.ui_timer.Stop()
+        if self.is_server_running: self.stop_server()
+        self.transfers.close()
+        if self.transfer_client: self.transfer_client.close()
         self.save_config(); self.Destroy()
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # server worker processes in frozen builds
     app = wx.App(False)
     frame = FileTransferApp()
     frame.Show()
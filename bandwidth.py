@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+
+# --- Token buckets ---
+class TokenBucket:
+    """Byte budget refilled at `rate` bytes/s up to `burst` bytes.
+
+    Callers reserve bytes up front and the bucket may go into debt; `reserve()` returns
+    how long the caller has to wait before the bytes are covered. Debt accumulates in
+    arrival order, so transfers that each reserve one chunk at a time take turns."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate / 4, 64 * 1024)
+        self.tokens = self.burst
+        self._stamp = time.monotonic()
+
+    def reserve(self, n):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        self.tokens -= n
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    @property
+    def idle(self):
+        return self.tokens + (time.monotonic() - self._stamp) * self.rate >= self.burst
+
+
+class BandwidthScheduler:
+    """Global and per-client byte rates (0 = unlimited) for one event loop.
+
+    Bulk data waits for `throttle()`; control replies such as LIST go through
+    `charge()`, which books their bytes without waiting, so they jump the queue and the
+    bulk transfers behind them absorb the cost."""
+
+    def __init__(self, rate=0, client_rate=0, quantum=256 * 1024):
+        self.rate = rate
+        self.client_rate = client_rate
+        self._global = TokenBucket(rate) if rate else None
+        self._clients = {}
+        # Bulk sends are cut into chunks of this size so that throttled transfers interleave.
+        self.quantum = quantum
+
+    @property
+    def limited(self):
+        return bool(self.rate or self.client_rate)
+
+    def _buckets(self, client):
+        buckets = [self._global] if self._global else []
+        if self.client_rate and client is not None:
+            bucket = self._clients.get(client)
+            if bucket is None:
+                if len(self._clients) > 1024:
+                    for key in [k for k, b in self._clients.items() if b.idle]: del self._clients[key]
+                bucket = self._clients[client] = TokenBucket(self.client_rate)
+            buckets.append(bucket)
+        return buckets
+
+    async def throttle(self, client, n):
+        if not self.limited: return
+        delay = max([b.reserve(n) for b in self._buckets(client)], default=0.0)
+        if delay: await asyncio.sleep(delay)
+
+    def charge(self, client, n):
+        if not self.limited: return
+        for bucket in self._buckets(client): bucket.reserve(n)
@@ -0,0 +1,260 @@
+"""Headless loopback benchmarks for the transfer engine (no wx needed).
+
+    python benchmark.py --output results.json
+    python benchmark.py --quick
+    python benchmark.py --only list --list-sizes 10 1000 100000
+
+Runs ServerEngine and TransferClient on 127.0.0.1 and reports UPLD/DNLD
+throughput, LIST latency and aggregate throughput under concurrency as JSON.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from compression import supported_codecs
+from server_engine import ServerEngine
+from server_pool import ServerPool
+from transfer_client import TransferClient
+
+MiB = 1024 * 1024
+
+
+# --- Helpers ---
+def write_file(path, size, chunk=4 * MiB):
+    # Random data so the numbers are not flattered by compression or sparse files.
+    with open(path, 'wb') as f:
+        left = size
+        while left > 0:
+            n = min(chunk, left)
+            f.write(os.urandom(n))
+            left -= n
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {'min': ordered[0], 'median': statistics.median(ordered), 'max': ordered[-1],
+            'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 'samples': len(ordered)}
+
+
+class Loopback:
+    """A ServerEngine (or a ServerPool of `workers` processes) on 127.0.0.1 with its own
+    temporary uploads directory."""
+
+    def __init__(self, use_ssl=False, certfile='cert.pem', keyfile='key.pem', uploads_dir=None, workers=1, **options):
+        self._owns_dir = uploads_dir is None
+        self.uploads_dir = uploads_dir or tempfile.mkdtemp(prefix='bench-srv-')
+        self.use_ssl = use_ssl
+        options.update(use_ssl=use_ssl, certfile=certfile, keyfile=keyfile, host='127.0.0.1')
+        if workers > 1:
+            self.engine = ServerPool(workers, 0, self.uploads_dir, **options)
+        else:
+            self.engine = ServerEngine(0, self.uploads_dir, **options)
+
+    def __enter__(self):
+        self.engine.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.engine.stop()
+        if self._owns_dir: shutil.rmtree(self.uploads_dir, ignore_errors=True)
+
+    def client(self, **options):
+        options.setdefault('delta_sync', False)
+        return TransferClient('127.0.0.1', self.engine.port, use_ssl=self.use_ssl, **options)
+
+
+# --- Benchmarks ---
+def bench_throughput(args, tls_modes, work):
+    results = []
+    for use_ssl in tls_modes:
+        with Loopback(use_ssl, args.certfile, args.keyfile, workers=args.workers) as server:
+            for size in args.sizes:
+                src = os.path.join(work, f'payload-{size}.bin')
+                if not os.path.exists(src): write_file(src, size)
+                for buffer_size in args.buffers:
+                    client = server.client(buffer_size=buffer_size, compression=args.compression)
+                    dest = tempfile.mkdtemp(dir=work)
+                    up, down = [], []
+                    try:
+                        for _ in range(args.repeat):
+                            start = time.perf_counter()
+                            if not client.upload(src): raise RuntimeError('upload failed')
+                            up.append(time.perf_counter() - start)
+                            start = time.perf_counter()
+                            if not client.download(os.path.basename(src), dest): raise RuntimeError('download failed')
+                            down.append(time.perf_counter() - start)
+                            os.remove(os.path.join(dest, os.path.basename(src)))
+                            # Drop the server copy so every upload is a full one.
+                            os.remove(os.path.join(server.uploads_dir, os.path.basename(src)))
+                    finally:
+                        client.close()
+                        shutil.rmtree(dest, ignore_errors=True)
+                    for direction, times in (('upload', up), ('download', down)):
+                        results.append({'direction': direction, 'tls': use_ssl, 'size': size,
+                                        'buffer_size': buffer_size, 'seconds': summarize(times),
+                                        'mib_per_s': size / MiB / statistics.median(times)})
+                        log(f"{direction:8} tls={use_ssl!s:5} size={size:>11} buffer={buffer_size:>8} "
+                            f"{results[-1]['mib_per_s']:9.1f} MiB/s")
+    return results
+
+
+def bench_list(args, tls_modes, work):
+    results = []
+    for count in args.list_sizes:
+        root = tempfile.mkdtemp(prefix='bench-list-', dir=work)
+        for i in range(count):
+            open(os.path.join(root, f'file-{i:06d}.dat'), 'wb').close()
+        for use_ssl in tls_modes:
+            with Loopback(use_ssl, args.certfile, args.keyfile, uploads_dir=root, workers=args.workers) as server:
+                client = server.client()
+                try:
+                    start = time.perf_counter()
+                    listed = len(client.refresh_listing())
+                    cold = time.perf_counter() - start
+                    full, delta = [], []
+                    for _ in range(args.repeat):
+                        client.listing_generation = 0
+                        start = time.perf_counter()
+                        client.refresh_listing()
+                        full.append(time.perf_counter() - start)
+                        start = time.perf_counter()
+                        client.refresh_listing()
+                        delta.append(time.perf_counter() - start)
+                finally:
+                    client.close()
+            if listed != count: raise RuntimeError(f'listed {listed} of {count} entries')
+            results.append({'entries': count, 'tls': use_ssl, 'cold_seconds': cold,
+                            'full_seconds': summarize(full), 'unchanged_seconds': summarize(delta)})
+            log(f"list     tls={use_ssl!s:5} entries={count:>7} cold={cold * 1000:9.2f} ms "
+                f"full={statistics.median(full) * 1000:9.2f} ms unchanged={statistics.median(delta) * 1000:7.2f} ms")
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def run_clients(server, count, action):
+    """Run `action(client, i)` on `count` clients released together; returns wall time,
+    per-client times and the errors raised."""
+    barrier = threading.Barrier(count + 1)
+    times, errors = [None] * count, []
+
+    def worker(i):
+        client = server.client(pool_size=1)
+        try:
+            barrier.wait()
+            start = time.perf_counter()
+            action(client, i)
+            times[i] = time.perf_counter() - start
+        except Exception as e:
+            errors.append(repr(e))
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(count)]
+    for t in threads: t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads: t.join()
+    return time.perf_counter() - start, [t for t in times if t is not None], errors
+
+
+def bench_concurrency(args, tls_modes, work):
+    results = []
+    src = os.path.join(work, 'concurrent.bin')
+    write_file(src, args.client_size)
+    top = max(args.clients)
+    names = []
+    for i in range(top):
+        # Every client uploads under its own name; hard links keep this cheap.
+        name = os.path.join(work, f'client-{i:04d}.bin')
+        try:
+            os.link(src, name)
+        except OSError:
+            shutil.copyfile(src, name)
+        names.append(name)
+    for use_ssl in tls_modes:
+        for count in args.clients:
+            with Loopback(use_ssl, args.certfile, args.keyfile, workers=args.workers, backlog=max(128, top),
+                          max_connections=(top + 16) * args.workers) as server:
+                dest = tempfile.mkdtemp(dir=work)
+
+                def upload(client, i):
+                    if not client.upload(names[i]): raise RuntimeError('upload failed')
+
+                def download(client, i):
+                    if not client.download(os.path.basename(names[i]), dest): raise RuntimeError('download failed')
+
+                for direction, action in (('upload', upload), ('download', download)):
+                    wall, times, errors = run_clients(server, count, action)
+                    done = len(times)
+                    results.append({'direction': direction, 'tls': use_ssl, 'clients': count,
+                                    'size_per_client': args.client_size, 'wall_seconds': wall,
+                                    'aggregate_mib_per_s': done * args.client_size / MiB / wall,
+                                    'client_seconds': summarize(times) if times else None,
+                                    'errors': len(errors), 'first_error': errors[0] if errors else None})
+                    log(f"{direction:8} tls={use_ssl!s:5} clients={count:>4} "
+                        f"{results[-1]['aggregate_mib_per_s']:9.1f} MiB/s aggregate, {len(errors)} errors")
+                shutil.rmtree(dest, ignore_errors=True)
+    return results
+
+
+# --- CLI ---
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    parser.add_argument('--only', nargs='+', choices=['throughput', 'list', 'concurrency'])
+    parser.add_argument('--tls', choices=['off', 'on', 'both'], default='both')
+    parser.add_argument('--certfile', default='cert.pem')
+    parser.add_argument('--keyfile', default='key.pem')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64 * 1024, MiB, 16 * MiB, 128 * MiB])
+    parser.add_argument('--buffers', type=int, nargs='+', default=[8192, 65536, 256 * 1024, MiB])
+    parser.add_argument('--list-sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 50, 100, 500])
+    parser.add_argument('--client-size', type=int, default=MiB)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=1, help='server worker processes (see server_pool)')
+    parser.add_argument('--compression', action='store_true', help='negotiate compression (off by default)')
+    parser.add_argument('--quick', action='store_true', help='small sizes and counts for a fast sanity run')
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.sizes, args.buffers = [MiB, 16 * MiB], [8192, 256 * 1024]
+        args.list_sizes, args.clients, args.client_size, args.repeat = [10, 1000], [1, 10, 50], 256 * 1024, 2
+
+    tls_modes = {'off': [False], 'on': [True], 'both': [False, True]}[args.tls]
+    skipped = []
+    if True in tls_modes and not (os.path.exists(args.certfile) and os.path.exists(args.keyfile)):
+        tls_modes = [m for m in tls_modes if not m]
+        skipped.append(f'tls: {args.certfile} / {args.keyfile} not found')
+    if not tls_modes: parser.error(f'TLS requested but {args.certfile} / {args.keyfile} not found')
+
+    report = {'meta': {'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'python': platform.python_version(),
+                       'platform': platform.platform(), 'cpus': os.cpu_count(), 'codecs': supported_codecs(),
+                       'compression': args.compression, 'repeat': args.repeat, 'workers': args.workers, 'skipped': skipped}}
+    benches = {'throughput': bench_throughput, 'list': bench_list, 'concurrency': bench_concurrency}
+    work = tempfile.mkdtemp(prefix='bench-')
+    try:
+        for name, bench in benches.items():
+            if args.only and name not in args.only: continue
+            report[name] = bench(args, tls_modes, work)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f: f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
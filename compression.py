@@ -0,0 +1,122 @@
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# --- Per-frame transfer compression ---
+# A compressed transfer is a run of frames, each a header (stored/compressed flag,
+# raw length, wire length) and its payload. Frames are compressed independently so
+# any frame that doesn't shrink can go out as-is.
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODEC_LZ4 = 3
+
+FRAME_SIZE = 256 * 1024
+MAX_FRAME_SIZE = 4 * 1024 * 1024
+FRAME_HEADER = struct.Struct('!BII')
+FRAME_STORED = 0
+FRAME_COMPRESSED = 1
+
+
+# Decompressors take the frame's declared raw length and never produce much more than
+# that, so a small frame can't expand into gigabytes before its length is checked.
+def _zlib_decompress(payload, limit):
+    d = zlib.decompressobj()
+    try:
+        data = d.decompress(payload, limit)
+        # Once `limit` bytes are out only the stream's end may be left.
+        if d.unconsumed_tail: data += d.decompress(d.unconsumed_tail, 1)
+    except zlib.error as e:
+        raise ValueError(f"Malformed compression frame: {e}") from None
+    if not d.eof or d.unconsumed_tail or d.unused_data: raise ValueError("Compression frame is longer than declared")
+    return data
+
+
+def _zstd_decompress(payload, limit):
+    try:
+        if zstandard.frame_content_size(payload) not in (-1, limit):
+            raise ValueError("Compression frame is longer than declared")
+        return zstandard.ZstdDecompressor().decompress(payload, max_output_size=limit)
+    except zstandard.ZstdError as e:
+        raise ValueError(f"Malformed compression frame: {e}") from None
+
+
+def _lz4_decompress(payload, limit):
+    d = lz4_frame.LZ4FrameDecompressor()
+    try:
+        data = d.decompress(payload, max_length=limit)
+        if not d.eof: data += d.decompress(b'', max_length=1)
+    except RuntimeError as e:
+        raise ValueError(f"Malformed compression frame: {e}") from None
+    if not d.eof or d.unused_data: raise ValueError("Compression frame is longer than declared")
+    return data
+
+
+CODECS = {CODEC_ZLIB: (lambda data: zlib.compress(data, 1), _zlib_decompress)}
+if zstandard:
+    CODECS[CODEC_ZSTD] = (lambda data: zstandard.ZstdCompressor(level=3).compress(data), _zstd_decompress)
+if lz4_frame:
+    CODECS[CODEC_LZ4] = (lz4_frame.compress, _lz4_decompress)
+
+
+def supported_codecs():
+    """Codecs available here, most preferred first."""
+    return [codec for codec in (CODEC_ZSTD, CODEC_LZ4, CODEC_ZLIB) if codec in CODECS]
+
+
+def choose_codec(offered):
+    return next((codec for codec in offered if codec in CODECS), CODEC_NONE)
+
+
+class FrameEncoder:
+    """Encodes raw chunks as frames of one codec, bypassing content that doesn't compress.
+
+    A frame is stored as-is when compression saves less than `min_saving`. After
+    `give_up` such frames in a row the encoder stops trying for `skip` frames, so
+    media and archives cost next to no CPU.
+    """
+
+    def __init__(self, codec, min_saving=0.1, give_up=4, skip=64):
+        self.compress = CODECS[codec][0]
+        self.min_saving = min_saving
+        self.give_up = give_up
+        self.skip = skip
+        self._misses = 0
+        self._skipping = 0
+
+    def encode(self, raw):
+        """Return (header, payload) for one frame."""
+        if self._skipping:
+            self._skipping -= 1
+        else:
+            packed = self.compress(raw)
+            if len(packed) <= len(raw) * (1 - self.min_saving):
+                self._misses = 0
+                return FRAME_HEADER.pack(FRAME_COMPRESSED, len(raw), len(packed)), packed
+            self._misses += 1
+            if self._misses >= self.give_up:
+                self._misses = 0
+                self._skipping = self.skip
+        return FRAME_HEADER.pack(FRAME_STORED, len(raw), len(raw)), raw
+
+
+def read_frame_header(header):
+    flag, raw_len, wire_len = FRAME_HEADER.unpack(header)
+    if flag not in (FRAME_STORED, FRAME_COMPRESSED) or raw_len > MAX_FRAME_SIZE or wire_len > MAX_FRAME_SIZE + 1024:
+        raise ValueError("Malformed compression frame")
+    return flag, raw_len, wire_len
+
+
+def decode_frame(codec, flag, raw_len, payload):
+    if raw_len > MAX_FRAME_SIZE: raise ValueError("Malformed compression frame")
+    data = CODECS[codec][1](payload, raw_len) if flag == FRAME_COMPRESSED else payload
+    if len(data) != raw_len: raise ValueError("Compression frame decoded to the wrong length")
+    return data
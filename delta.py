@@ -0,0 +1,107 @@
+import hashlib
+import math
+import struct
+import zlib
+
+# --- rsync-style block signatures and deltas ---
+# The weak checksum is Adler-32, so whole blocks go through zlib.adler32 and only
+# the byte-by-byte search rolls it in Python.
+ADLER_MOD = 65521
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 1024 * 1024
+SIGNATURE_SIZE = 4 + 16
+
+# Delta stream opcodes.
+OP_LITERAL = b'L'
+OP_BLOCKS = b'B'
+OP_END = b'E'
+
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def choose_block_size(size):
+    # Roughly sqrt(size) like rsync, rounded to a power of two.
+    block = 1 << max(0, int(math.sqrt(size))).bit_length()
+    return max(MIN_BLOCK_SIZE, min(block, MAX_BLOCK_SIZE))
+
+
+def block_signatures(path, block_size):
+    signatures = []
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            signatures.append((zlib.adler32(block), strong_hash(block)))
+    return signatures
+
+
+def pack_signatures(signatures):
+    return b''.join(struct.pack('!I', weak) + strong for weak, strong in signatures)
+
+
+def unpack_signatures(data):
+    return [(struct.unpack_from('!I', data, i)[0], bytes(data[i + 4:i + SIGNATURE_SIZE]))
+            for i in range(0, len(data), SIGNATURE_SIZE)]
+
+
+def roll(weak, out_byte, in_byte, block_size):
+    a = ((weak & 0xffff) - out_byte + in_byte) % ADLER_MOD
+    b = ((weak >> 16) - block_size * out_byte + a - 1) % ADLER_MOD
+    return (b << 16) | a
+
+
+def compute_delta(data, signatures, block_size, basis_size, resync_every=32):
+    """Describe `data` (any buffer, usually an mmap) against the signatures of a basis file.
+
+    Yields (OP_LITERAL, start, end) for bytes that must be sent and (OP_BLOCKS, index, end)
+    for a basis block the receiver already has that ends at `end` in `data`.
+
+    After losing sync the weak checksum rolls one byte at a time for two blocks, which
+    realigns after short insertions and deletions. Past that the search strides a block
+    at a time and rolls through one block after 1, 2, 4, ... strides, then every
+    `resync_every`. Any block's worth of positions past an edit holds an alignment, so a
+    longer insertion still costs about twice its length at most, while a wholly changed
+    region costs mostly one zlib call per block instead of a Python step per byte.
+    """
+    table = {}
+    for index, (weak, strong) in enumerate(signatures): table.setdefault(weak, []).append((strong, index))
+    full_blocks = basis_size // block_size
+
+    def match(weak, start, end):
+        candidates = table.get(weak)
+        if not candidates: return None
+        strong = strong_hash(data[start:end])
+        for candidate, index in candidates:
+            if candidate == strong and (index < full_blocks or end - start < block_size): return index
+        return None
+
+    n = len(data)
+    pos = literal = 0
+    weak = None
+    budget, strides = 2 * block_size, 0
+    while pos + block_size <= n:
+        if weak is None: weak = zlib.adler32(data[pos:pos + block_size])
+        index = match(weak, pos, pos + block_size)
+        if index is not None:
+            if literal < pos: yield OP_LITERAL, literal, pos
+            pos += block_size
+            yield OP_BLOCKS, index, pos
+            literal, weak = pos, None
+            budget, strides = 2 * block_size, 0
+        elif budget > 0 and pos + block_size < n:
+            weak = roll(weak, data[pos], data[pos + block_size], block_size)
+            pos += 1
+            budget -= 1
+        else:
+            pos += block_size
+            weak = None
+            strides += 1
+            if strides % resync_every == 0 or strides & (strides - 1) == 0: budget = block_size
+    # The basis may end in a short block; the new file can reuse it only as its own tail.
+    tail = n - literal
+    if 0 < tail < block_size and basis_size % block_size == tail:
+        index = match(zlib.adler32(data[literal:n]), literal, n)
+        if index == full_blocks:
+            yield OP_BLOCKS, index, n
+            return
+    if literal < n: yield OP_LITERAL, literal, n
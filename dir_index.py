@@ -0,0 +1,241 @@
+import glob
+import hashlib
+import json
+import os
+import time
+
+from protocol import STAGING_DIR, FileEntry
+
+
+# The persistent SHA-256 cache sits next to the root directory ('server_uploads.hashes.json'),
+# so saving it neither shows up in listings nor moves the root's mtime.
+HASH_INDEX_SUFFIX = '.hashes.json'
+
+
+def hash_file(path, block_size=1024 * 1024, length=None, offset=0):
+    """SHA-256 of the file, or of `length` bytes of it from `offset`."""
+    return hash_prefix(path, block_size, length, offset).digest()
+
+
+def hash_prefix(path, block_size=1024 * 1024, length=None, offset=0):
+    """Running SHA-256 over the first `length` bytes (all of them if None), ready for
+    the rest of the data to be fed in. With an `offset`, the bytes counted from there."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        left = length
+        while left is None or left > 0:
+            block = f.read(block_size if left is None else min(block_size, left))
+            if not block: break
+            digest.update(block)
+            if left is not None: left -= len(block)
+    return digest
+
+
+# --- Cached server-side directory listing ---
+class DirectoryIndex:
+    """In-memory listing of the uploads directory that LIST answers from.
+
+    Names are '/'-separated paths relative to the root. The engine reports its own
+    uploads through `update()`. Changes made behind its back are picked up by a rescan
+    when `stale()`: only when the root directory's mtime moved (so edits inside
+    subdirectories wait for the next rescan) and at most once per `rescan_interval`
+    seconds. `scan()` only reads the tree, so it can run on a worker thread while the
+    index keeps serving; `apply_scan()` then brings the index up to date. Every change is
+    stamped with a generation number so clients can ask for what changed since
+    their last listing.
+
+    Content digests are attached with `set_digest()` and persisted by `save_digests()`;
+    they stay valid for as long as the file's size and mtime do. They are saved to
+    `digests_file` (by default next to the root, see HASH_INDEX_SUFFIX) and loaded from
+    every '<root>.hashes*.json', so processes sharing a root each write a file of their own.
+    """
+
+    def __init__(self, root, rescan_interval=2.0, max_removed=10000, first_generation=None, digests_file=None):
+        self.root = root
+        self.digests_file = digests_file or os.path.normpath(os.path.abspath(root)) + HASH_INDEX_SUFFIX
+        self.rescan_interval = rescan_interval
+        self.max_removed = max_removed
+        # Generations start from the wall clock, so those of a restarted server are
+        # always newer than anything a client remembers from the previous run.
+        self.generation = time.time_ns() if first_generation is None else first_generation
+        self.floor = self.generation
+        self.entries = {}
+        self._by_content = {}  # (size, digest) -> names of the entries with that content
+        self._removed = {}
+        self._dir_mtime = None
+        self._last_scan = 0.0
+        self._stored_digests = self._load_digests()
+        self.digests_dirty = False
+        self.rescan()
+        self._stored_digests = {}
+
+    def _next_generation(self):
+        self.generation += 1
+        return self.generation
+
+    def _set(self, name, size, mtime):
+        entry = self.entries.get(name)
+        if entry and entry.size == size and entry.mtime == mtime: return
+        stored = self._stored_digests.get(name)
+        digest = bytes.fromhex(stored[2]) if stored and stored[0] == size and stored[1] == mtime else None
+        if entry: self._unlink(entry)
+        self.entries[name] = FileEntry(name, size, mtime, digest, self._next_generation())
+        self._link(self.entries[name])
+        self._removed.pop(name, None)
+        if entry and entry.digest: self.digests_dirty = True
+
+    def _remove(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is None: return
+        self._unlink(entry)
+        if entry.digest: self.digests_dirty = True
+        if len(self._removed) >= self.max_removed:
+            # Forget old deletions; clients older than this point get a full listing instead.
+            self._removed.clear()
+            self.floor = self.generation
+        self._removed[name] = self._next_generation()
+
+    def rescan(self):
+        self.apply_scan(self.scan(), self.generation)
+
+    def scan(self):
+        """Read the tree without touching the index; safe on a worker thread."""
+        dir_mtime = os.stat(self.root).st_mtime_ns
+        files = {}
+        self._scan(self.root, '', files)
+        return dir_mtime, files
+
+    def apply_scan(self, scan, since):
+        """Apply a scan() started at generation `since`. Files that update() recorded in
+        the meantime keep that newer state."""
+        dir_mtime, files = scan
+        self._dir_mtime = max(self._dir_mtime or 0, dir_mtime)
+        self._last_scan = time.monotonic()
+        for name, (size, mtime) in files.items():
+            entry = self.entries.get(name)
+            if (entry and entry.generation > since) or self._removed.get(name, 0) > since: continue
+            self._set(name, size, mtime)
+        for name in [n for n, e in self.entries.items() if n not in files and e.generation <= since]:
+            self._remove(name)
+
+    def _scan(self, path, prefix, files):
+        with os.scandir(path) as it:
+            for de in it:
+                name = prefix + de.name
+                if name == STAGING_DIR: continue
+                try:
+                    if de.is_dir(follow_symlinks=False):
+                        self._scan(de.path, name + '/', files)
+                        continue
+                    if not de.is_file(): continue
+                    st = de.stat()
+                except OSError:
+                    continue
+                files[name] = (st.st_size, st.st_mtime)
+
+    def stale(self):
+        """Whether a rescan is due: the root's mtime moved, checked at most once per
+        rescan_interval."""
+        if time.monotonic() - self._last_scan < self.rescan_interval: return False
+        try:
+            changed = os.stat(self.root).st_mtime_ns != self._dir_mtime
+        except OSError:
+            return False
+        if not changed: self._last_scan = time.monotonic()
+        return changed
+
+    def refresh(self):
+        if self.stale(): self.rescan()
+
+    def update(self, name, root_mtime=None):
+        """Record the current state of one file after the engine changed it. `root_mtime` is
+        the root's mtime from just before the engine renamed the file into place: if the
+        index had seen that one, the rename is what moved it and the new mtime is taken
+        rather than mistaken for an outside change; if not, something else changed the root
+        in between and the next refresh() rescans."""
+        if root_mtime is not None and root_mtime == self._dir_mtime:
+            try:
+                self._dir_mtime = os.stat(self.root).st_mtime_ns
+            except OSError:
+                pass
+        elif root_mtime is not None:
+            self._dir_mtime, self._last_scan = None, 0.0
+        try:
+            st = os.stat(os.path.join(self.root, name))
+        except OSError:
+            self._remove(name)
+            return
+        self._set(name, st.st_size, st.st_mtime)
+
+    def under(self, path):
+        """Entries for `path` itself or, if it names a directory, everything below it."""
+        entry = self.entries.get(path)
+        if entry: return [entry]
+        prefix = path.rstrip('/') + '/'
+        return sorted((e for n, e in self.entries.items() if n.startswith(prefix)), key=lambda e: e.name)
+
+    def changes_since(self, since):
+        """Return (full, entries, removed names) needed to bring a listing at `since` up to date."""
+        # A generation this index never handed out (another worker's) gets a full listing too.
+        if since < self.floor or since > self.generation:
+            return True, sorted(self.entries.values(), key=lambda e: e.name), []
+        entries = sorted((e for e in self.entries.values() if e.generation > since), key=lambda e: e.name)
+        removed = sorted(n for n, gen in self._removed.items() if gen > since)
+        return False, entries, removed
+
+    # --- Content digests ---
+    def set_digest(self, entry, digest):
+        """Attach `digest` to `entry` unless the file was replaced in the meantime."""
+        if self.entries.get(entry.name) is not entry or entry.digest == digest: return
+        self._unlink(entry)
+        entry.digest = digest
+        self._link(entry)
+        self.digests_dirty = True
+
+    def _link(self, entry):
+        if entry.digest: self._by_content.setdefault((entry.size, entry.digest), set()).add(entry.name)
+
+    def _unlink(self, entry):
+        names = self._by_content.get((entry.size, entry.digest))
+        if names is None: return
+        names.discard(entry.name)
+        if not names: del self._by_content[(entry.size, entry.digest)]
+
+    def find_content(self, size, digest):
+        """An entry whose content hashes to `digest`, checked against the file on disk."""
+        for entry in [self.entries[name] for name in self._by_content.get((size, digest), ())]:
+            try:
+                st = os.stat(os.path.join(self.root, entry.name))
+            except OSError:
+                st = None
+            if st and st.st_size == entry.size and st.st_mtime == entry.mtime: return entry
+            self.update(entry.name)  # changed behind our back; its digest no longer applies
+        return None
+
+    def _load_digests(self):
+        # Oldest file first, so where files disagree the most recently saved digest wins.
+        base = glob.escape(os.path.normpath(os.path.abspath(self.root)))
+        paths = set(glob.glob(base + HASH_INDEX_SUFFIX.replace('.json', '*.json'))) | {self.digests_file}
+        merged = {}
+        for path in sorted(paths, key=lambda p: os.path.getmtime(p) if os.path.exists(p) else 0):
+            try:
+                with open(path) as f:
+                    stored = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if isinstance(stored, dict): merged.update(stored)
+        return merged
+
+    def save_digests(self):
+        """Write the known digests out; safe to call from a worker thread."""
+        self.digests_dirty = False
+        stored = {e.name: [e.size, e.mtime, e.digest.hex()] for e in list(self.entries.values()) if e.digest}
+        path = self.digests_file
+        tmp = f"{path}.{os.getpid()}.{time.monotonic_ns()}.tmp"
+        try:
+            with open(tmp, 'w') as f: json.dump(stored, f)
+            os.replace(tmp, path)
+        except OSError:
+            if os.path.exists(tmp): os.remove(tmp)
+            raise
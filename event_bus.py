@@ -0,0 +1,43 @@
+import collections
+import threading
+import time
+
+
+# --- Worker threads -> UI event bus ---
+class EventBus:
+    """Hands log lines and state updates from any thread to a UI that takes them in batches
+    with drain(), typically from a timer running at a fixed frame rate.
+
+    Log lines queue per channel in ring buffers of `max_lines`: when the UI falls behind,
+    the oldest lines go first and are counted. Updates are keyed and coalesce, so between
+    two drains only the latest value per key is kept; a transfer that reports progress a
+    hundred times per frame costs the UI one refresh.
+    """
+
+    def __init__(self, max_lines=1000):
+        self.max_lines = max_lines
+        self._lock = threading.Lock()
+        self._logs = {}
+        self._dropped = collections.Counter()
+        self._updates = {}
+
+    def log(self, channel, message, log_type='info'):
+        line = (time.strftime('%H:%M:%S'), message, log_type)
+        with self._lock:
+            lines = self._logs.get(channel)
+            if lines is None: lines = self._logs[channel] = collections.deque(maxlen=self.max_lines)
+            if len(lines) == self.max_lines: self._dropped[channel] += 1
+            lines.append(line)
+
+    def update(self, key, value):
+        with self._lock: self._updates[key] = value
+
+    def drain(self):
+        """Return ({channel: (lines, dropped count)}, latest update values) and start over.
+        Lines are (time, message, log type) tuples, oldest first."""
+        with self._lock:
+            logs = {channel: (list(lines), self._dropped.pop(channel, 0))
+                    for channel, lines in self._logs.items() if lines}
+            for lines in self._logs.values(): lines.clear()
+            updates, self._updates = list(self._updates.values()), {}
+        return logs, updates
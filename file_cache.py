@@ -0,0 +1,73 @@
+import collections
+import mmap
+import os
+
+
+def load_file(f, size):
+    """The first `size` bytes of the open file `f` as a read-only buffer: a shared mapping
+    where possible, otherwise a copy in memory (always on Windows, where a mapped file
+    can't be replaced)."""
+    if os.name != 'nt':
+        try:
+            return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            pass  # filesystem without mmap support, or the file shrank
+    f.seek(0)
+    data = f.read(size)
+    if len(data) != size: raise OSError("File shrank while caching.")
+    return data
+
+
+# --- Hot-file cache ---
+class FileCache:
+    """LRU of whole-file buffers, so files that are sent again and again aren't read from
+    disk for every request. Holds at most `budget` bytes; files larger than `max_file`
+    (default a quarter of the budget) are never cached.
+
+    Entries are keyed by path and checked against the file's inode, size and mtime on
+    every lookup. Mapping files is safe because stored files are always replaced, never
+    rewritten in place. Views handed out stay valid after their entry is evicted; the
+    buffer is released with the last of them. Not thread-safe: one event loop uses it.
+    """
+
+    def __init__(self, budget, max_file=None):
+        self.budget = budget
+        self.max_file = budget // 4 if max_file is None else max_file
+        self.size = 0
+        self._entries = collections.OrderedDict()
+
+    @staticmethod
+    def _stamp(st):
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def admits(self, size):
+        return 0 < size <= min(self.max_file, self.budget)
+
+    def get(self, path, st):
+        """Cached view of `path` if it still matches `st` (an os.stat_result), else None."""
+        entry = self._entries.get(path)
+        if entry is None: return None
+        if entry[0] != self._stamp(st):
+            self.invalidate(path)
+            return None
+        self._entries.move_to_end(path)
+        return entry[1]
+
+    def put(self, path, st, data):
+        """Cache `data` (from load_file) as the contents of `path` and return a view of it."""
+        self.invalidate(path)
+        view = memoryview(data)
+        self._entries[path] = (self._stamp(st), view)
+        self.size += len(view)
+        while self.size > self.budget:
+            _, (_, old) = self._entries.popitem(last=False)
+            self.size -= len(old)
+        return view
+
+    def invalidate(self, path):
+        entry = self._entries.pop(path, None)
+        if entry: self.size -= len(entry[1])
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
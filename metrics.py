@@ -0,0 +1,93 @@
+import bisect
+import os
+import time
+
+# Histogram bucket upper bounds in seconds, from 100 µs to an hour.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DURATION_BUCKETS = LATENCY_BUCKETS + (300.0, 900.0, 3600.0)
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs: return ''
+    escaped = (f'{k}="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+               for k, v in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+# --- In-process metrics registry ---
+class Metrics:
+    """Counters, gauges and histograms keyed by name and labels, rendered in the Prometheus
+    text format. Meant for a single event loop thread: updates are plain dict and int
+    operations with no locking."""
+
+    def __init__(self, prefix='', const_labels=None):
+        self.prefix = prefix
+        self.const_labels = tuple(sorted((const_labels or {}).items()))
+        self._kinds = {}
+        self._values = {}
+
+    def describe(self, name, kind, help_text, buckets=LATENCY_BUCKETS):
+        self._kinds[name] = (kind, help_text, buckets)
+        self._values.setdefault(name, {})
+
+    def inc(self, name, value=1, **labels):
+        series = self._values[name]
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self._values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        series = self._values[name]
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None: histogram = series[key] = Histogram(self._kinds[name][2])
+        histogram.observe(value)
+
+    def render(self):
+        lines = []
+        for name, (kind, help_text, _) in self._kinds.items():
+            full = self.prefix + name
+            lines.append(f'# HELP {full} {help_text}')
+            lines.append(f'# TYPE {full} {kind}')
+            for key, value in list(self._values[name].items()):
+                labels = self.const_labels + key
+                if kind != 'histogram':
+                    lines.append(f'{full}{_format_labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.bounds + (float('inf'),), value.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{full}_bucket{_format_labels(labels, [("le", le)])} {cumulative}')
+                lines.append(f'{full}_sum{_format_labels(labels)} {value.sum}')
+                lines.append(f'{full}_count{_format_labels(labels)} {value.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_file(self, path):
+        """Write render() to `path` atomically (for node_exporter's textfile collector)."""
+        tmp = f"{path}.{os.getpid()}.{time.monotonic_ns()}.tmp"
+        try:
+            with open(tmp, 'w') as f: f.write(self.render())
+            os.replace(tmp, path)
+        except OSError:
+            if os.path.exists(tmp): os.remove(tmp)
+            raise
@@ -0,0 +1,117 @@
+import os
+import struct
+
+
+# --- Wire protocol shared by server_engine and transfer_client ---
+# Every connection is a session: the client sends any number of commands, each a
+# 4-byte opcode followed by its fields, and the server answers each one in turn
+# with a self-delimiting reply. The session ends on QUIT or when the client closes.
+CMD_UPLOAD = b'UPLD'
+CMD_DOWNLOAD = b'DNLD'
+CMD_LIST = b'LIST'
+CMD_RESUME = b'RSUM'
+CMD_PART = b'PART'
+CMD_COMMIT = b'COMT'
+CMD_ABORT = b'ABRT'
+CMD_STRIPES = b'STRP'
+CMD_SIGNATURES = b'SIGS'
+CMD_DELTA = b'DLTA'
+CMD_BATCH_UPLOAD = b'BUPL'
+CMD_BATCH_DOWNLOAD = b'BDNL'
+CMD_CODECS = b'CODC'
+CMD_HAVE = b'HAVE'
+CMD_STATS = b'STAT'
+CMD_QUIT = b'QUIT'
+
+STATUS_OK = b'OK'
+STATUS_ERROR = b'ER'
+STATUS_NOT_FOUND = b'NF'
+
+# Interrupted transfers are kept under this suffix on both sides so they can be
+# resumed from their current size; completed files are renamed into place.
+PARTIAL_SUFFIX = '.part'
+# The server keeps its partial and staging files in this directory of the uploads
+# root, hidden from listings, so stored files themselves may have any name.
+STAGING_DIR = '.partial'
+
+# Transfers are checked end to end against the file's SHA-256; an all-zero digest
+# means there is nothing to check (e.g. an empty range).
+DIGEST_SIZE = 32
+NO_DIGEST = bytes(DIGEST_SIZE)
+
+# LIST request flags and per-entry record kinds.
+LIST_WITH_HASHES = 0x01
+ENTRY_PRESENT = 0
+ENTRY_REMOVED = 1
+
+
+class FileEntry:
+    __slots__ = ('name', 'size', 'mtime', 'digest', 'generation')
+
+    def __init__(self, name, size=0, mtime=0.0, digest=None, generation=0):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.digest = digest
+        self.generation = generation
+
+
+def split_relpath(name):
+    """Split a '/'-separated relative path into safe components, rejecting anything that
+    could escape the directory it is joined to: '..', the reserved STAGING_DIR at the top
+    and, on Windows, ':' (drive letters and NTFS streams)."""
+    parts = [p for p in name.replace('\\', '/').split('/') if p not in ('', '.')]
+    if (not parts or '..' in parts or parts[0] == STAGING_DIR
+            or (os.name == 'nt' and any(':' in p for p in parts))):
+        raise ValueError(f"Invalid file name: {name!r}")
+    return parts
+
+
+def pack_string(s):
+    data = s.encode('utf-8')
+    return struct.pack('!I', len(data)) + data
+
+
+def recv_exactly(sock, num_bytes):
+    d = bytearray(num_bytes)
+    mv = memoryview(d)
+    br = 0
+    while br < num_bytes:
+        c = sock.recv_into(mv[br:], num_bytes - br)
+        if c == 0: raise ConnectionError("Connection closed by peer.")
+        br += c
+    return d
+
+
+def recv_string(sock):
+    return recv_exactly(sock, struct.unpack('!I', recv_exactly(sock, 4))[0]).decode('utf-8')
+
+
+# --- LIST pages: a run of entry records, framed by a 4-byte length ---
+def pack_entry(entry):
+    digest = entry.digest or b''
+    return (bytes([ENTRY_PRESENT]) + pack_string(entry.name) +
+            struct.pack('!QdB', entry.size, entry.mtime, len(digest)) + digest)
+
+
+def pack_removed(name):
+    return bytes([ENTRY_REMOVED]) + pack_string(name)
+
+
+def unpack_page(page):
+    """Return (entries, removed names) from one LIST page."""
+    entries, removed, pos = [], [], 0
+    while pos < len(page):
+        kind = page[pos]
+        name_len = struct.unpack_from('!I', page, pos + 1)[0]
+        name = bytes(page[pos + 5:pos + 5 + name_len]).decode('utf-8')
+        pos += 5 + name_len
+        if kind == ENTRY_REMOVED:
+            removed.append(name)
+            continue
+        size, mtime, digest_len = struct.unpack_from('!QdB', page, pos)
+        pos += 17
+        digest = bytes(page[pos:pos + digest_len]) or None
+        pos += digest_len
+        entries.append(FileEntry(name, size, mtime, digest))
+    return entries, removed
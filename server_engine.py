@@ -0,0 +1,1321 @@
+import asyncio
+import collections
+import contextvars
+import functools
+import hashlib
+import os
+import shutil
+import ssl
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bandwidth import BandwidthScheduler
+from compression import (CODEC_NONE, CODECS, FRAME_SIZE, FrameEncoder, choose_codec, decode_frame,
+                         read_frame_header)
+from delta import (MAX_BLOCK_SIZE, MIN_BLOCK_SIZE, OP_BLOCKS, OP_END, OP_LITERAL, block_signatures,
+                   choose_block_size, pack_signatures)
+from dir_index import DirectoryIndex, hash_file, hash_prefix
+from file_cache import FileCache, load_file
+from metrics import DURATION_BUCKETS, Metrics
+from protocol import (CMD_ABORT, CMD_BATCH_DOWNLOAD, CMD_BATCH_UPLOAD, CMD_CODECS, CMD_COMMIT, CMD_DELTA, CMD_DOWNLOAD,
+                      CMD_HAVE, CMD_LIST, CMD_PART, CMD_QUIT, CMD_RESUME, CMD_SIGNATURES, CMD_STATS, CMD_STRIPES,
+                      CMD_UPLOAD, DIGEST_SIZE, LIST_WITH_HASHES, NO_DIGEST, PARTIAL_SUFFIX, STAGING_DIR, STATUS_ERROR,
+                      STATUS_NOT_FOUND, STATUS_OK, pack_entry, pack_removed, pack_string, split_relpath)
+from stream_io import MAX_CHUNK, MIN_CHUNK, ChunkSizer, preallocate
+
+# New digests are written to the persistent hash index at most this often (seconds).
+DIGEST_SAVE_DELAY = 5.0
+
+# Address of the client the current connection task serves, for per-client rate limits.
+_peer = contextvars.ContextVar('peer', default=None)
+
+# Received data is handed to the disk thread in writes of about this size, and an upload
+# may have this much queued before its connection stops reading and waits for the disk.
+WRITE_BEHIND_CHUNK = 1024 * 1024
+WRITE_BEHIND_LIMIT = 16 * 1024 * 1024
+
+# Next to a striped upload's staging file: the stripes received and verified so far, one
+# "offset length" line each. A file, because stripes may reach different worker processes.
+STRIPES_SUFFIX = '.stripes'
+# How many digests of ranges sent to striped downloads are remembered.
+RANGE_DIGESTS = 1024
+
+# Files in STAGING_DIR untouched for this long (seconds) belong to uploads that were given
+# up on; they are removed at startup and every STAGING_SWEEP_INTERVAL seconds.
+STAGING_TTL = 24 * 3600.0
+STAGING_SWEEP_INTERVAL = 3600.0
+
+
+class _SessionProtocol(asyncio.StreamReaderProtocol, asyncio.BufferedProtocol):
+    """StreamReaderProtocol that reads the transport into buffers it is given. Commands and
+    headers go through a scratch buffer to the StreamReader as usual; a bulk payload goes
+    straight into the buffer passed to receive_into(), so there is no bytes object per read
+    and no copy to join them.
+
+    `fed` counts the bytes handed to the StreamReader and `direct` those received into
+    given buffers, which tells the engine how much the StreamReader has read ahead."""
+
+    def __init__(self, reader, client_connected_cb):
+        super().__init__(reader, client_connected_cb)
+        self._scratch = memoryview(bytearray(2 ** 16))
+        self._target = None
+        self._waiter = None
+        self._lost = None
+        self.filled = 0
+        self.fed = 0
+        self.direct = 0
+
+    def get_buffer(self, sizehint):
+        return self._scratch if self._target is None else self._target[self.filled:]
+
+    def buffer_updated(self, nbytes):
+        if self._target is None:
+            self.fed += nbytes
+            self.data_received(self._scratch[:nbytes])
+            return
+        self.filled += nbytes
+        if self.filled == len(self._target):
+            self.direct += self.filled
+            self._finish()
+
+    def receive_into(self, view):
+        """Future that is done once `view` has been filled from the transport. Data that
+        arrives afterwards goes to the StreamReader again."""
+        self._target, self.filled = view, 0
+        self._waiter = asyncio.get_running_loop().create_future()
+        if self._lost: self._finish(self._lost)
+        return self._waiter
+
+    def stop_receiving(self):
+        # Let go of the buffer, e.g. after a timeout; the transport must not write to it later.
+        waiter, self._waiter, self._target = self._waiter, None, None
+        if waiter is not None and not waiter.done(): waiter.cancel()
+
+    def _finish(self, exc=None):
+        waiter, self._waiter, self._target = self._waiter, None, None
+        if waiter is None or waiter.done(): return
+        if exc is None:
+            waiter.set_result(None)
+        else:
+            waiter.set_exception(exc)
+
+    def eof_received(self):
+        self._lost = asyncio.IncompleteReadError(b'', None)
+        self._finish(self._lost)
+        return super().eof_received()
+
+    def connection_lost(self, exc):
+        self._lost = self._lost or exc or asyncio.IncompleteReadError(b'', None)
+        self._finish(self._lost)
+        super().connection_lost(exc)
+
+
+class _BufferPool:
+    """Receive buffers in power-of-two sizes from MIN_CHUNK to MAX_CHUNK, reused from one
+    upload to the next. Keeps at most `budget` bytes of idle buffers."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.idle = 0
+        self._free = collections.defaultdict(list)
+
+    def take(self, size):
+        # A writable view of `size` bytes (at most MAX_CHUNK); give() it back when done.
+        capacity = MIN_CHUNK
+        while capacity < size: capacity *= 2
+        free = self._free[capacity]
+        if free:
+            self.idle -= capacity
+            return memoryview(free.pop())[:size]
+        return memoryview(bytearray(capacity))[:size]
+
+    def give(self, view):
+        buf = view.obj
+        if self.idle + len(buf) > self.budget: return
+        self._free[len(buf)].append(buf)
+        self.idle += len(buf)
+
+
+class _MeteredWriter:
+    """StreamWriter wrapper that counts the bytes written and notes when the first byte of
+    the current reply went out."""
+
+    def __init__(self, writer):
+        self._writer = writer
+        self.sent = 0
+        self.first_write = None
+
+    def count(self, n):
+        if self.first_write is None: self.first_write = time.perf_counter()
+        self.sent += n
+
+    def write(self, data):
+        self.count(len(data))
+        self._writer.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+
+class _WriteBehind:
+    """Write-behind queue for one file: the connection hands over received data and keeps
+    reading while the engine's disk thread writes it (and feeds `digest`) in order. Data is
+    either copied in with write() or received into a pooled buffer from reserve() that is
+    queued as it is with commit().
+
+    Use as an async context manager; leaving it waits for the queued writes, so `written`
+    is then the number of bytes that reached the file. The first write error is raised
+    from `write()` or on exit, and everything queued after it is skipped."""
+
+    def __init__(self, engine, f, digest=None):
+        self._engine = engine
+        self._f = f
+        self._digest = digest
+        self._batch = []
+        self._batched = 0
+        self._jobs = collections.deque()
+        self._queued = 0
+        self.written = 0
+        self.error = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._submit()
+        while self._jobs: await self._complete()
+        if self.error and exc_type is None: raise self.error
+
+    async def write(self, data):
+        self._batch.append(data)
+        self._batched += len(data)
+        if self._batched >= WRITE_BEHIND_CHUNK: self._submit()
+        while self._queued > WRITE_BEHIND_LIMIT: await self._complete()
+        if self.error: raise self.error
+
+    async def reserve(self, size):
+        while self._jobs and self._queued + size > WRITE_BEHIND_LIMIT: await self._complete()
+        if self.error: raise self.error
+        return self._engine.buffers.take(size)
+
+    async def commit(self, view):
+        self._submit()
+        self._queue(view, pooled=True)
+        if self.error: raise self.error
+
+    def _submit(self):
+        if not self._batch: return
+        self._queue(self._batch[0] if len(self._batch) == 1 else b''.join(self._batch))
+        self._batch, self._batched = [], 0
+
+    def _queue(self, data, pooled=False):
+        job = self._engine.loop.run_in_executor(self._engine.disk, self._run, data)
+        self._jobs.append((job, len(data), data if pooled else None))
+        self._queued += len(data)
+
+    def _run(self, data):
+        # Runs on the disk thread. Returns the time the write took, or None if skipped.
+        if self.error: return None
+        started = time.perf_counter()
+        try:
+            self._f.write(data)
+        except (OSError, ValueError) as e:
+            self.error = e
+            return None
+        if self._digest: self._digest.update(data)
+        return time.perf_counter() - started
+
+    async def _complete(self):
+        job, n, buffer = self._jobs[0]
+        # Shielded: a cancelled connection must not cancel a write that later ones depend on.
+        seconds = await asyncio.shield(job)
+        self._jobs.popleft()
+        self._queued -= n
+        if buffer is not None: self._engine.buffers.give(buffer)
+        if seconds is None: return
+        self.written += n
+        self._engine.metrics.observe('disk_write_seconds', seconds)
+
+
+# --- Headless asyncio server engine ---
+class ServerEngine:
+    """Serves UPLD/DNLD/LIST sessions (plus the resume and striping commands) from a
+    single asyncio event loop. Upload payloads are received into pooled buffers (see
+    _SessionProtocol) and written to disk by a dedicated thread (see _WriteBehind), so a
+    slow disk doesn't stall the loop.
+
+    The engine has no GUI dependency: `start()` runs the loop on a background
+    thread (used by the wx app), `run()` blocks the calling thread. Given an already
+    listening `sock` it serves that instead of binding `host`/`port` (see server_pool).
+    `rate_limit` and `client_rate_limit` cap bulk data in bytes/s overall and per client
+    address (0 = unlimited). Counters and histograms in `metrics` are served by STAT and,
+    with `metrics_file`, written in Prometheus text format every `metrics_interval` seconds.
+    Files sent over TLS or compressed are served from a hot-file cache of up to
+    `cache_size` bytes (0 = off); plain sends use sendfile and don't need it.
+    """
+
+    def __init__(self, port, uploads_dir, use_ssl=False, certfile='cert.pem', keyfile='key.pem', host='',
+                 backlog=128, max_connections=256, idle_timeout=300.0, buffer_size=65536, log=None,
+                 sock=None, first_generation=None, on_change=None, rate_limit=0, client_rate_limit=0,
+                 metrics_file=None, metrics_interval=15.0, metrics_labels=None, cache_size=256 * 1024 * 1024,
+                 digests_file=None):
+        self.host = host
+        self.port = port
+        self.uploads_dir = uploads_dir
+        self.use_ssl = use_ssl
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.buffer_size = buffer_size
+        self.scheduler = BandwidthScheduler(rate_limit, client_rate_limit)
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        self.metrics = self._create_metrics(metrics_labels)
+        self.file_cache = FileCache(cache_size) if cache_size else None
+        self.buffers = _BufferPool(WRITE_BEHIND_LIMIT)
+        self._log = log
+        self.sock = sock
+        self.first_generation = first_generation
+        self.digests_file = digests_file
+        # Called with the index name of every file this engine adds or replaces and, when
+        # the index knows its SHA-256 already, its FileEntry (otherwise None).
+        self.on_change = on_change
+        self.active_connections = 0
+        self.index = None
+        self.loop = None
+        self._server = None
+        self._thread = None
+        self._stop_event = None
+        self._connections = set()
+        self._digest_save = None
+        self._rescan = None
+        self._hashing = {}  # (name, size, mtime) -> hash of that file running on an executor
+        self._prefixes = {}  # .part path -> (stat stamp, running SHA-256 of it) from the last RSUM
+        self._range_digests = {}  # (name, size, mtime, offset, count) -> SHA-256 of a range sent, oldest first
+        self.disk = None
+        self.allocator = None
+        self._allocating = {}  # staging path -> preallocation of that file running on the allocator
+        self._handlers = {CMD_UPLOAD: self._handle_upload, CMD_DOWNLOAD: self._handle_download,
+                          CMD_LIST: self._handle_list, CMD_RESUME: self._handle_resume,
+                          CMD_PART: self._handle_part, CMD_COMMIT: self._handle_commit, CMD_ABORT: self._handle_abort,
+                          CMD_STRIPES: self._handle_stripes,
+                          CMD_SIGNATURES: self._handle_signatures, CMD_DELTA: self._handle_delta,
+                          CMD_BATCH_UPLOAD: self._handle_batch_upload, CMD_BATCH_DOWNLOAD: self._handle_batch_download,
+                          CMD_CODECS: self._handle_codecs, CMD_HAVE: self._handle_have,
+                          CMD_STATS: self._handle_stats}
+
+    def log(self, message, log_type='info'):
+        if self._log: self._log(message, log_type)
+
+    @staticmethod
+    def _create_metrics(labels):
+        m = Metrics('transfer_', labels)
+        m.describe('connections_active', 'gauge', 'Open client connections.')
+        m.describe('connections_total', 'counter', 'Accepted client connections.')
+        m.describe('connections_rejected_total', 'counter', 'Connections refused at max_connections.')
+        m.describe('commands_total', 'counter', 'Commands handled.')
+        m.describe('bytes_total', 'counter', 'Bytes received (in) and sent (out) while handling each command.')
+        m.describe('command_duration_seconds', 'histogram', 'Time to handle a command, data transfer included.',
+                   DURATION_BUCKETS)
+        m.describe('time_to_first_byte_seconds', 'histogram', 'Time from a command arriving to its first reply byte.')
+        m.describe('tls_handshake_seconds', 'histogram', 'Time from TCP accept to a completed TLS handshake.')
+        m.describe('disk_write_seconds', 'histogram', 'Time per write of received data to disk.')
+        m.describe('file_cache_requests_total', 'counter', 'Sends served from the hot-file cache (hit) or not (miss).')
+        m.describe('file_cache_bytes', 'gauge', 'Bytes of file content held by the hot-file cache.')
+        m.set('connections_active', 0)
+        return m
+
+    # --- Lifecycle ---
+    def start(self):
+        ready, errors = threading.Event(), []
+        self._thread = threading.Thread(target=self.run, args=(ready, errors), daemon=True)
+        self._thread.start()
+        ready.wait()
+        if errors:
+            self._thread.join()
+            raise errors[0]
+
+    def stop(self, timeout=5.0):
+        if self.loop and self._stop_event and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self._stop_event.set)
+            except RuntimeError:
+                pass
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        self._thread = None
+
+    def run(self, ready=None, errors=None):
+        try:
+            asyncio.run(self._main(ready, errors))
+        except Exception as e:
+            if errors is None: raise
+            if not errors: errors.append(e)
+        finally:
+            if ready: ready.set()
+
+    async def _main(self, ready, errors):
+        self.loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self.disk = ThreadPoolExecutor(1, thread_name_prefix='disk-writer')
+        self.allocator = ThreadPoolExecutor(1, thread_name_prefix='disk-allocator')
+        os.makedirs(os.path.join(self.uploads_dir, STAGING_DIR), exist_ok=True)
+        self.index = DirectoryIndex(self.uploads_dir, first_generation=self.first_generation,
+                                    digests_file=self.digests_file)
+        ssl_context = None
+        if self.use_ssl:
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(self.certfile, self.keyfile)
+        handshake_timeout = self.idle_timeout if ssl_context else None
+        try:
+            if self.sock is not None:
+                self._server = await self.loop.create_server(
+                    self._protocol, sock=self.sock, ssl=ssl_context, ssl_handshake_timeout=handshake_timeout)
+            else:
+                self._server = await self.loop.create_server(
+                    self._protocol, self.host or None, self.port, ssl=ssl_context, backlog=self.backlog,
+                    reuse_address=True, ssl_handshake_timeout=handshake_timeout)
+        except Exception as e:
+            if errors is None: raise
+            errors.append(e)
+            return
+        self.port = self._server.sockets[0].getsockname()[1]
+        if ready: ready.set()
+        metrics_task = asyncio.create_task(self._write_metrics()) if self.metrics_file else None
+        sweep_task = asyncio.create_task(self._sweep_staging())
+        try:
+            await self._stop_event.wait()
+        finally:
+            if metrics_task: metrics_task.cancel()
+            sweep_task.cancel()
+            self._server.close()
+            for task in list(self._connections): task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self.disk.shutdown()
+            self.allocator.shutdown()
+            if self.file_cache: self.file_cache.clear()
+            if self._digest_save: self._digest_save.cancel()
+            self._save_digests()
+            if self.metrics_file: self._save_metrics()
+
+    # --- Metrics ---
+    async def _write_metrics(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            await self.loop.run_in_executor(None, self._save_metrics)
+
+    # --- Abandoned uploads ---
+    async def _sweep_staging(self):
+        while True:
+            await self.loop.run_in_executor(None, self._expire_staging, time.time() - STAGING_TTL)
+            await asyncio.sleep(STAGING_SWEEP_INTERVAL)
+
+    def _expire_staging(self, cutoff):
+        # Runs on an executor. A staging file counts as touched when its .stripes is, and the
+        # .stripes goes first, so no listing of verified stripes outlives the data it lists.
+        staging_dir = os.path.join(self.uploads_dir, STAGING_DIR)
+        try:
+            names = set(os.listdir(staging_dir))
+        except OSError as e:
+            self.log(f"Could not sweep {staging_dir}: {e}", 'error')
+            return
+        for name in names:
+            if name.endswith(STRIPES_SUFFIX) and name[:-len(STRIPES_SUFFIX)] in names: continue
+            paths = [os.path.join(staging_dir, n) for n in (name + STRIPES_SUFFIX, name) if n in names]
+            try:
+                if max(os.path.getmtime(path) for path in paths) < cutoff: self._remove(*paths)
+            except OSError:
+                pass
+
+    def _save_metrics(self):
+        try:
+            self.metrics.write_file(self.metrics_file)
+        except OSError as e:
+            self.log(f"Could not write metrics to {self.metrics_file}: {e}", 'error')
+
+    def _record_command(self, cmd, started, received, sent, first_write):
+        name = cmd.decode('ascii', 'replace')
+        self.metrics.inc('commands_total', command=name)
+        self.metrics.inc('bytes_total', received, command=name, direction='in')
+        self.metrics.inc('bytes_total', sent, command=name, direction='out')
+        self.metrics.observe('command_duration_seconds', time.perf_counter() - started, command=name)
+        if first_write is not None:
+            self.metrics.observe('time_to_first_byte_seconds', first_write - started, command=name)
+
+    # --- Connection handling ---
+    def _protocol(self):
+        # What asyncio.start_server builds per connection, plus the accept time: with TLS the
+        # handler only runs once the handshake is done, so the difference is the handshake.
+        reader = asyncio.StreamReader(limit=2 ** 16)
+        reader.session = _SessionProtocol(
+            reader, functools.partial(self._handle_client, accepted=time.perf_counter()))
+        return reader.session
+
+    async def _handle_client(self, reader, writer, accepted=None):
+        addr = writer.get_extra_info('peername') or ('?',)
+        if self.use_ssl and accepted is not None:
+            self.metrics.observe('tls_handshake_seconds', time.perf_counter() - accepted)
+        if self.active_connections >= self.max_connections:
+            self.log(f"Connection limit ({self.max_connections}) reached, rejected {addr[0]}.", 'error')
+            self.metrics.inc('connections_rejected_total')
+            writer.close()
+            return
+        task = asyncio.current_task()
+        _peer.set(addr[0])
+        self._connections.add(task)
+        self.active_connections += 1
+        self.metrics.inc('connections_total')
+        self.metrics.set('connections_active', self.active_connections)
+        reader.received = 0
+        writer = _MeteredWriter(writer)
+        try:
+            while True:
+                try:
+                    cmd = await self._read(reader, 4)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break  # client closed or left the session idle
+                if cmd == CMD_QUIT: break
+                handler = self._handlers.get(cmd)
+                if handler is None:
+                    self.log(f"Unknown command {cmd!r} from {addr[0]}.", 'error')
+                    break
+                started, received, sent = time.perf_counter(), reader.received, writer.sent
+                writer.first_write = None
+                try:
+                    keep_open = await handler(reader, writer)
+                finally:
+                    self._record_command(cmd, started, reader.received - received, writer.sent - sent,
+                                         writer.first_write)
+                if not keep_open: break
+        except asyncio.TimeoutError:
+            self.log(f"Connection from {addr[0]} stalled for {self.idle_timeout:g}s, closed.", 'error')
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError, UnicodeDecodeError):
+            pass
+        except asyncio.CancelledError:
+            pass  # engine shutting down
+        finally:
+            self.active_connections -= 1
+            self.metrics.set('connections_active', self.active_connections)
+            self._connections.discard(task)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (Exception, asyncio.CancelledError):
+                pass
+
+    def apply_change(self, name, known=None):
+        """Thread-safe: refresh one index entry changed by another process, which may pass
+        its FileEntry for the new content along (see on_change)."""
+        if self.loop and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self._external_change, name, known)
+            except RuntimeError:
+                pass
+
+    def _external_change(self, name, known):
+        self.index.update(name)
+        self._uncache(self._upload_path(name))
+        entry = self.index.entries.get(name)
+        # The digest only holds for the version of the file the other process saw.
+        if known and entry and (entry.size, entry.mtime) == (known.size, known.mtime):
+            self._remember_digest(entry, known.digest)
+
+    async def _refresh_index(self):
+        # Rescans read the tree on an executor thread; only applying the result runs on the
+        # loop. Concurrent callers share one rescan.
+        if self._rescan is None:
+            if not self.index.stale(): return
+            self._rescan = asyncio.ensure_future(self._rescan_index())
+        await asyncio.shield(self._rescan)
+
+    async def _rescan_index(self):
+        try:
+            since = self.index.generation
+            scan = await asyncio.get_running_loop().run_in_executor(None, self.index.scan)
+            self.index.apply_scan(scan, since)
+        finally:
+            self._rescan = None
+
+    def _replace(self, staging, fp):
+        # Moves an upload into place and returns the root's mtime from just before, for _changed.
+        before = os.stat(self.uploads_dir).st_mtime_ns
+        os.replace(staging, fp)
+        return before
+
+    def _changed(self, fp, digest=None, root_mtime=None):
+        # `digest` is the verified SHA-256 of the new content, when the handler has one;
+        # `root_mtime` is what _replace returned.
+        name = self._index_name(fp)
+        self.index.update(name, root_mtime)
+        self._uncache(fp)
+        entry = self.index.entries.get(name)
+        if digest and entry: self._remember_digest(entry, digest)
+        if self.on_change: self.on_change(name, entry if entry and entry.digest else None)
+
+    # --- Hot-file cache ---
+    def _uncache(self, fp):
+        if not self.file_cache: return
+        self.file_cache.invalidate(fp)
+        self.metrics.set('file_cache_bytes', self.file_cache.size)
+
+    async def _cached(self, f):
+        # The whole of `f` from the hot-file cache, loading it on a miss; None for files the
+        # cache doesn't take.
+        try:
+            st = os.fstat(f.fileno())
+            view = self.file_cache.get(f.name, st)
+            if view is not None:
+                self.metrics.inc('file_cache_requests_total', result='hit')
+                return view
+            if not self.file_cache.admits(st.st_size): return None
+            self.metrics.inc('file_cache_requests_total', result='miss')
+            data = await asyncio.get_running_loop().run_in_executor(None, load_file, f, st.st_size)
+        except (OSError, ValueError):
+            return None
+        view = self.file_cache.put(f.name, st, data)
+        self.metrics.set('file_cache_bytes', self.file_cache.size)
+        return view
+
+    # --- Content digests ---
+    def _remember_digest(self, entry, digest):
+        self.index.set_digest(entry, digest)
+        if self.index.digests_dirty and self._digest_save is None:
+            self._digest_save = self.loop.call_later(DIGEST_SAVE_DELAY, self._save_digests_soon)
+
+    def _save_digests_soon(self):
+        self._digest_save = None
+        self.loop.run_in_executor(None, self._save_digests)
+
+    def _save_digests(self):
+        if not self.index.digests_dirty: return
+        try:
+            self.index.save_digests()
+        except OSError as e:
+            self.log(f"Could not save the hash index: {e}", 'error')
+
+    def _current_entry(self, name):
+        # The index entry of a stored file, brought up to date first if the file changed.
+        entry = self.index.entries.get(name)
+        st = os.stat(os.path.join(self.uploads_dir, *name.split('/')))
+        if entry is None or entry.size != st.st_size or entry.mtime != st.st_mtime:
+            self.index.update(name)
+            entry = self.index.entries.get(name)
+        return entry
+
+    async def _file_digest(self, name):
+        """SHA-256 of a stored file, from the index when it is still current. Requests for a
+        file that is already being hashed wait for that hash rather than start another."""
+        entry = self._current_entry(name)
+        if entry and entry.digest: return entry.digest
+        key = (name, entry.size, entry.mtime) if entry else (name,)
+        job = self._hashing.get(key)
+        if job is None:
+            job = self._hashing[key] = asyncio.get_running_loop().run_in_executor(
+                None, hash_file, os.path.join(self.uploads_dir, *name.split('/')))
+            job.add_done_callback(lambda _: self._hashing.pop(key, None))
+        digest = await asyncio.shield(job)
+        if entry: self._remember_digest(entry, digest)
+        return digest
+
+    async def _read(self, reader, num_bytes):
+        data = await asyncio.wait_for(reader.readexactly(num_bytes), self.idle_timeout)
+        reader.received += num_bytes
+        return data
+
+    async def _read_some(self, reader, max_bytes):
+        # Payloads that are skipped rather than stored are read this way, throttled like the rest.
+        data = await asyncio.wait_for(reader.read(max_bytes), self.idle_timeout)
+        if not data: raise asyncio.IncompleteReadError(b'', max_bytes)
+        reader.received += len(data)
+        await self.scheduler.throttle(_peer.get(), len(data))
+        return data
+
+    async def _recv_into(self, reader, view):
+        # Fills `view` straight from the transport. The StreamReader may already hold the
+        # first bytes, read ahead with the payload's header: those are copied over first,
+        # without yielding to the loop, so none can arrive in between.
+        session = reader.session
+        held = min(session.fed - (reader.received - session.direct), len(view))
+        if held:
+            view[:held] = await reader.readexactly(held)
+            reader.received += held
+            if held == len(view): return
+        waiter = session.receive_into(view[held:])
+        try:
+            progress = 0
+            while not waiter.done():
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    # Idle means nothing arrived at all, not a chunk that took long.
+                    if session.filled == progress: raise
+                    progress = session.filled
+        finally:
+            session.stop_receiving()
+        reader.received += len(view) - held
+
+    async def _drain(self, writer):
+        await asyncio.wait_for(writer.drain(), self.idle_timeout)
+
+    async def _on_disk(self, func, *args):
+        # Filesystem calls that can block for a while (truncate, rename, remove) run on the
+        # disk thread, behind queued writes.
+        return await self.loop.run_in_executor(self.disk, func, *args)
+
+    async def _preallocate(self, f, size, key=None):
+        # On a thread of its own: where the filesystem lacks fallocate, glibc emulates it by
+        # writing every block, which mustn't hold up other uploads' writes on the disk thread.
+        # Connections sharing a staging file (`key`) wait for one allocation of it.
+        job = self._allocating.get(key)
+        if job is None:
+            job = self.loop.run_in_executor(self.allocator, preallocate, f, size)
+            if key:
+                self._allocating[key] = job
+                job.add_done_callback(lambda _: self._allocating.pop(key, None))
+        await asyncio.shield(job)
+
+    async def _read_filename(self, reader):
+        fn_len = struct.unpack('!I', await self._read(reader, 4))[0]
+        return (await self._read(reader, fn_len)).decode('utf-8')
+
+    def _upload_path(self, fn):
+        return os.path.join(self.uploads_dir, *split_relpath(fn))
+
+    def _index_name(self, fp):
+        return os.path.relpath(fp, self.uploads_dir).replace(os.sep, '/')
+
+    def _partial_path(self, fn, token=None):
+        # Files in STAGING_DIR are named after a hash of the stored name, so nested and long
+        # names need no subdirectories there: the interrupted upload of `fn`, or with a
+        # `token` one of its staging files.
+        key = hashlib.sha256('/'.join(split_relpath(fn)).encode('utf-8')).hexdigest()[:32]
+        name = f"{key}.{token}{PARTIAL_SUFFIX}" if token else key + PARTIAL_SUFFIX
+        return os.path.join(self.uploads_dir, STAGING_DIR, name)
+
+    def _staging_path(self, fn, token):
+        # Striped uploads share one staging file per (name, token) across their connections.
+        if not token.isalnum() or len(token) > 64: raise ValueError(f"Invalid upload token: {token!r}")
+        return self._partial_path(fn, token)
+
+    async def _read_codec(self, reader):
+        codec = (await self._read(reader, 1))[0]
+        if codec != CODEC_NONE and codec not in CODECS: raise ValueError(f"Unsupported codec {codec}")
+        return codec
+
+    async def _receive_range(self, reader, sink, length, codec=CODEC_NONE):
+        # Receives `length` bytes into buffers queued on `sink` (a _WriteBehind), in chunks
+        # sized to take about the same time at the rate the client is sending.
+        if codec != CODEC_NONE:
+            await self._receive_frames(reader, sink, length, codec)
+            return
+        sizer = ChunkSizer(self.buffer_size, high=self.scheduler.quantum if self.scheduler.limited else MAX_CHUNK)
+        rec = 0
+        while rec < length:
+            view = await sink.reserve(min(sizer.size, length - rec))
+            started = time.perf_counter()
+            await self._recv_into(reader, view)
+            sizer.record(len(view), time.perf_counter() - started)
+            await self.scheduler.throttle(_peer.get(), len(view))
+            await sink.commit(view)
+            rec += len(view)
+
+    async def _receive_frames(self, reader, sink, length, codec):
+        # Frame n decompresses on an executor thread while frame n + 1 is read off the socket.
+        loop = asyncio.get_running_loop()
+        rec, pending = 0, None
+        try:
+            while rec < length:
+                flag, raw_len, wire_len = read_frame_header(await self._read(reader, 9))
+                if rec + raw_len > length: raise ValueError("Compressed stream overruns its range")
+                payload = await self._read(reader, wire_len)
+                await self.scheduler.throttle(_peer.get(), wire_len)
+                if pending: await sink.write(await pending)
+                pending = loop.run_in_executor(None, decode_frame, codec, flag, raw_len, payload)
+                rec += raw_len
+            if pending: await sink.write(await pending)
+        finally:
+            self._settle(pending)
+
+    def _settle(self, pending):
+        # Drop an executor job whose result is no longer wanted without leaving its error unretrieved.
+        if pending is None: return
+        if not pending.done():
+            pending.cancel()
+        elif not pending.cancelled():
+            pending.exception()
+
+    async def _reply(self, writer, ok):
+        writer.write(STATUS_OK if ok else STATUS_ERROR)
+        await self._drain(writer)
+        return ok
+
+    # --- Command handlers: return False to end the session ---
+    async def _handle_list(self, reader, writer):
+        # Streams the index as length-framed pages, then a zero-length frame, the index
+        # generation and whether the listing is complete (full) or only changes since `since`.
+        since, page_size, flags = struct.unpack('!QIB', await self._read(reader, 13))
+        await self._refresh_index()
+        generation = self.index.generation
+        full, entries, removed = self.index.changes_since(since)
+        if flags & LIST_WITH_HASHES:
+            # Shares hashes already running for downloads; a file found changed is listed as it is now.
+            for i, entry in enumerate(entries):
+                if entry.digest is None:
+                    try:
+                        await self._file_digest(entry.name)
+                    except OSError:
+                        continue
+                    entries[i] = self.index.entries.get(entry.name, entry)
+        records = [pack_entry(e) for e in entries] + [pack_removed(n) for n in removed]
+        page_size = max(1, min(page_size, 10000))
+        for i in range(0, len(records), page_size):
+            page = b''.join(records[i:i + page_size])
+            self.scheduler.charge(_peer.get(), len(page))  # never queued behind bulk data
+            writer.write(struct.pack('!I', len(page)) + page)
+            await self._drain(writer)
+        writer.write(struct.pack('!IQ?', 0, generation, full))
+        await self._drain(writer)
+        return True
+
+    async def _handle_resume(self, reader, writer):
+        # Reply with how many bytes of an interrupted upload are already on disk and their
+        # SHA-256, so the client can check they are a prefix of the file it is sending and
+        # start again from 0 if not. UPLD reuses the hash unless the .part changes meanwhile.
+        fn = await self._read_filename(reader)
+        held, digest = 0, NO_DIGEST
+        try:
+            part = self._partial_path(fn)
+            stamp = self._stamp(os.stat(part))
+            if stamp[1]:
+                prefix = await asyncio.get_running_loop().run_in_executor(None, hash_prefix, part, 1024 * 1024, stamp[1])
+                if self._stamp(os.stat(part)) == stamp:
+                    if len(self._prefixes) >= 64: self._prefixes.clear()
+                    self._prefixes[part] = (stamp, prefix.copy())
+                    held, digest = stamp[1], prefix.digest()
+        except (OSError, ValueError):
+            pass
+        writer.write(struct.pack(f'!Q{DIGEST_SIZE}s', held, digest))
+        await self._drain(writer)
+        return True
+
+    @staticmethod
+    def _stamp(st):
+        # Identifies one version of a file; a rename keeps it.
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    async def _handle_upload(self, reader, writer):
+        # Writes [offset, offset + length) of a `total`-byte file into a staging file of its
+        # own, preallocated to `total`, and moves it into place once the range reaches the end
+        # of the file and the whole file matches the client's SHA-256 (hashed while writing,
+        # plus any held prefix). A resumed upload first claims the interrupted .part by
+        # renaming it, so two uploads of one name never share a file; whatever arrived of an
+        # unfinished upload goes back to the .part for RSUM.
+        fn = await self._read_filename(reader)
+        total, offset, length = struct.unpack('!QQQ', await self._read(reader, 24))
+        staging, kept = None, 0
+        try:
+            codec = await self._read_codec(reader)
+            expected = await self._read(reader, DIGEST_SIZE)
+            fp = self._upload_path(fn)
+            part = self._partial_path(fn)
+            os.makedirs(os.path.dirname(fp), exist_ok=True)
+            staging = self._staging_path(fn, os.urandom(8).hex())
+            held, prefix = 0, self._prefixes.pop(part, None)
+            if offset:
+                try:
+                    await self._on_disk(os.rename, part, staging)
+                    held = kept = os.path.getsize(staging)
+                except FileNotFoundError:
+                    pass  # nothing to resume, or another upload of this name holds it
+            if offset > held or offset + length > total:
+                raise ValueError(f"Range {offset}+{length} does not fit {fn} ({held} of {total} bytes held)")
+            digest = None
+            if offset + length == total and not offset:
+                digest = hashlib.sha256()
+            elif offset + length == total:
+                # Reuse the prefix hash RSUM worked out if the .part hasn't changed since.
+                if prefix and prefix[0] == self._stamp(os.stat(staging)) and held == offset:
+                    digest = prefix[1]
+                else:
+                    digest = await asyncio.get_running_loop().run_in_executor(
+                        None, hash_prefix, staging, 1024 * 1024, offset)
+            with open(staging, 'r+b' if offset else 'wb') as f:
+                await self._on_disk(f.truncate, offset)
+                kept = offset
+                await self._preallocate(f, total)
+                f.seek(offset)
+                sink = _WriteBehind(self, f, digest)
+                try:
+                    async with sink:
+                        await self._receive_range(reader, sink, length, codec)
+                finally:
+                    kept = offset + sink.written
+            if digest:
+                if digest.digest() != expected:
+                    kept = 0
+                    raise ValueError(f"{fn} does not match the client's SHA-256")
+                before = await self._on_disk(self._replace, staging, fp)
+                staging = None
+                # A fresh upload supersedes a .part the client found not to be its prefix.
+                if not offset: await self._on_disk(self._remove, part)
+                self._changed(fp, expected, before)
+        except (ConnectionError, asyncio.TimeoutError):
+            # A dropped or stalled connection ends the session; it isn't a failed upload.
+            raise
+        except (OSError, ValueError) as e:
+            # The rest of the payload is still in flight, so the session can't continue.
+            self.log(f"Upload failed: {e}", 'error')
+            return await self._reply(writer, False)
+        finally:
+            if staging: await self._on_disk(self._shelve, staging, part, kept)
+        return await self._reply(writer, True)
+
+    @staticmethod
+    def _remove(*paths):
+        # Runs on the disk thread.
+        for path in paths:
+            if os.path.exists(path): os.remove(path)
+
+    def _shelve(self, staging, part, kept):
+        # Runs on the disk thread. Keep the first `kept` bytes of an unfinished upload as its .part (the newest
+        # interrupted upload of a name wins), or drop the staging file if there are none.
+        try:
+            if kept:
+                os.truncate(staging, kept)
+                os.replace(staging, part)
+            elif os.path.exists(staging):
+                os.remove(staging)
+        except OSError as e:
+            self.log(f"Could not keep partial upload {part}: {e}", 'error')
+
+    async def _handle_part(self, reader, writer):
+        # One stripe of a striped upload: same range fields as UPLD, written in place into a
+        # staging file preallocated to the full size, then the SHA-256 of the stripe, checked
+        # against what was written. Nothing is visible until COMT.
+        fn = await self._read_filename(reader)
+        token = await self._read_filename(reader)
+        total, offset, length = struct.unpack('!QQQ', await self._read(reader, 24))
+        try:
+            staging = self._staging_path(fn, token)
+            if offset + length > total: raise ValueError(f"Range {offset}+{length} exceeds {total} bytes")
+            os.makedirs(os.path.dirname(self._upload_path(fn)), exist_ok=True)
+            try:
+                fd = os.open(staging, os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o644)
+            except FileExistsError:
+                fd = os.open(staging, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+            else:
+                # A new staging file: stripes listed for an earlier one went with its data.
+                await self._on_disk(self._remove, staging + STRIPES_SUFFIX)
+            digest = hashlib.sha256()
+            with os.fdopen(fd, 'r+b') as f:
+                if os.fstat(fd).st_size < total: await self._preallocate(f, total, staging)
+                f.seek(offset)
+                async with _WriteBehind(self, f, digest) as sink:
+                    await self._receive_range(reader, sink, length)
+            if await self._read(reader, DIGEST_SIZE) != digest.digest():
+                raise ValueError(f"Stripe {offset}+{length} of {fn} does not match the client's SHA-256")
+            with open(staging + STRIPES_SUFFIX, 'a') as stripes: stripes.write(f"{offset} {length}\n")
+        except (ConnectionError, asyncio.TimeoutError):
+            raise
+        except (OSError, ValueError) as e:
+            self.log(f"Upload failed: {e}", 'error')
+            return await self._reply(writer, False)
+        return await self._reply(writer, True)
+
+    async def _handle_commit(self, reader, writer):
+        # Moves a striped upload into place once its verified stripes cover the whole file.
+        # The staging file is claimed by renaming it first, so an ABRT sent while this runs
+        # can't delete it. The file's digest is left for the index to work out when needed.
+        fn = await self._read_filename(reader)
+        token = await self._read_filename(reader)
+        total = struct.unpack('!Q', await self._read(reader, 8))[0]
+        try:
+            staging = self._staging_path(fn, token)
+            claimed = staging + '.commit'
+            try:
+                await self._on_disk(os.rename, staging, claimed)
+            except FileNotFoundError:
+                raise ValueError(f"Nothing staged for {fn}") from None
+            try:
+                if os.path.getsize(claimed) != total or not self._stripes_cover(staging + STRIPES_SUFFIX, total):
+                    raise ValueError(f"Staged {fn} is missing stripes")
+                fp = self._upload_path(fn)
+                before = await self._on_disk(self._replace, claimed, fp)
+            finally:
+                await self._on_disk(self._remove, staging + STRIPES_SUFFIX, claimed)
+            self._changed(fp, root_mtime=before)
+        except (OSError, ValueError) as e:
+            self.log(f"Upload failed: {e}", 'error')
+            await self._reply(writer, False)
+            return True
+        return await self._reply(writer, True)
+
+    @staticmethod
+    def _read_stripes(path):
+        # The (offset, length) stripes listed in `path` (see STRIPES_SUFFIX), sorted.
+        with open(path) as f:
+            return sorted(tuple(map(int, line.split())) for line in f if line.strip())
+
+    def _stripes_cover(self, path, total):
+        # Whether the stripes listed in `path` cover [0, total).
+        try:
+            stripes = self._read_stripes(path)
+        except (OSError, ValueError):
+            return False
+        end = 0
+        for offset, length in stripes:
+            if offset > end: return False
+            end = max(end, offset + length)
+        return end >= total
+
+    async def _handle_abort(self, reader, writer):
+        fn = await self._read_filename(reader)
+        token = await self._read_filename(reader)
+        try:
+            staging = self._staging_path(fn, token)
+            await self._on_disk(self._remove, staging + STRIPES_SUFFIX, staging)
+        except (OSError, ValueError):
+            pass
+        return await self._reply(writer, True)
+
+    async def _handle_stripes(self, reader, writer):
+        # The stripes of the striped upload staged under `token` that arrived and were
+        # verified, as a count and (offset, length) pairs, so a resumed upload sends the rest.
+        fn = await self._read_filename(reader)
+        token = await self._read_filename(reader)
+        try:
+            staging = self._staging_path(fn, token)
+            stripes = self._read_stripes(staging + STRIPES_SUFFIX) if os.path.exists(staging) else []
+        except (OSError, ValueError):
+            stripes = []
+        writer.write(struct.pack('!I', len(stripes)) + b''.join(struct.pack('!QQ', *stripe) for stripe in stripes))
+        await self._drain(writer)
+        return True
+
+    async def _handle_signatures(self, reader, writer):
+        # Block signatures of the stored file, for a client preparing a delta upload.
+        fn = await self._read_filename(reader)
+        block_size = struct.unpack('!I', await self._read(reader, 4))[0]
+        try:
+            fp = self._upload_path(fn)
+            fs = os.path.getsize(fp)
+            block_size = max(MIN_BLOCK_SIZE, min(block_size, MAX_BLOCK_SIZE)) if block_size else choose_block_size(fs)
+            signatures = await asyncio.get_running_loop().run_in_executor(None, block_signatures, fp, block_size)
+        except (OSError, ValueError):
+            writer.write(STATUS_NOT_FOUND)
+            await self._drain(writer)
+            return True
+        writer.write(STATUS_OK + struct.pack('!QII', fs, block_size, len(signatures)) + pack_signatures(signatures))
+        await self._drain(writer)
+        return True
+
+    async def _handle_delta(self, reader, writer):
+        # Rebuilds a file from literal data and runs of blocks of the stored copy, checks the
+        # result against the client's SHA-256 and swaps it in.
+        fn = await self._read_filename(reader)
+        total, block_size = struct.unpack('!QI', await self._read(reader, 12))
+        staging = None
+        try:
+            fp = self._upload_path(fn)
+            staging = self._staging_path(fn, os.urandom(8).hex())
+            digest = hashlib.sha256()
+            with open(fp, 'rb') as basis, open(staging, 'wb') as out:
+                await self._preallocate(out, total)
+                async with _WriteBehind(self, out, digest) as sink:
+                    while True:
+                        op = await self._read(reader, 1)
+                        if op == OP_LITERAL:
+                            length = struct.unpack('!I', await self._read(reader, 4))[0]
+                            await self._receive_range(reader, sink, length)
+                        elif op == OP_BLOCKS:
+                            first, count = struct.unpack('!II', await self._read(reader, 8))
+                            basis.seek(first * block_size)
+                            remaining = count * block_size
+                            while remaining:
+                                c = basis.read(min(remaining, MAX_BLOCK_SIZE))
+                                if not c: break
+                                await sink.write(c)
+                                remaining -= len(c)
+                        elif op == OP_END:
+                            expected = await self._read(reader, 32)
+                            break
+                        else:
+                            raise ValueError(f"Unknown delta opcode {op!r}")
+                size = sink.written
+            if size != total or digest.digest() != expected:
+                raise ValueError(f"Rebuilt {fn} does not match the client's copy")
+            before = await self._on_disk(self._replace, staging, fp)
+            staging = None
+            self._changed(fp, expected, before)
+        except (ConnectionError, asyncio.TimeoutError):
+            raise
+        except (OSError, ValueError) as e:
+            self.log(f"Delta upload failed: {e}", 'error')
+            return await self._reply(writer, False)
+        finally:
+            if staging: await self._on_disk(self._remove, staging)
+        return await self._reply(writer, True)
+
+    async def _handle_batch_upload(self, reader, writer):
+        # Files arrive back to back as name, size, data and SHA-256 until an empty name; the
+        # client doesn't wait for per-file replies, so failures are reported once at the end.
+        stored, failed = 0, []
+        while True:
+            fn = await self._read_filename(reader)
+            if not fn: break
+            size = struct.unpack('!Q', await self._read(reader, 8))[0]
+            staging, start = None, reader.received
+            try:
+                fp = self._upload_path(fn)
+                os.makedirs(os.path.dirname(fp), exist_ok=True)
+                staging = self._staging_path(fn, os.urandom(8).hex())
+                digest = hashlib.sha256()
+                with open(staging, 'wb') as f:
+                    await self._preallocate(f, size)
+                    async with _WriteBehind(self, f, digest) as sink:
+                        await self._receive_range(reader, sink, size)
+                if await self._read(reader, DIGEST_SIZE) != digest.digest():
+                    raise ValueError(f"{fn} does not match the client's SHA-256")
+                before = await self._on_disk(self._replace, staging, fp)
+                staging = None
+                self._changed(fp, digest.digest(), before)
+                stored += 1
+            except (OSError, ValueError) as e:
+                if isinstance(e, (ConnectionError, asyncio.TimeoutError)): raise
+                self.log(f"Batch upload of {fn} failed: {e}", 'error')
+                failed.append(fn)
+                await self._discard(reader, size + DIGEST_SIZE - (reader.received - start))
+            finally:
+                if staging: await self._on_disk(self._remove, staging)
+        writer.write(struct.pack('!II', stored, len(failed)) + b''.join(pack_string(fn) for fn in failed))
+        await self._drain(writer)
+        return True
+
+    async def _discard(self, reader, length):
+        # Skip the rest of a payload that can't be stored, keeping the session in sync.
+        while length:
+            length -= len(await self._read_some(reader, min(self.buffer_size, length)))
+
+    async def _handle_batch_download(self, reader, writer):
+        # Request: a count and that many names, where a directory name selects everything
+        # below it. Reply: file count and total bytes, then each file as name, found flag,
+        # size, data and SHA-256 (see _send_with_digest), ending with an empty name.
+        count = struct.unpack('!I', await self._read(reader, 4))[0]
+        names = [await self._read_filename(reader) for _ in range(count)]
+        await self._refresh_index()
+        selected, missing = [], []
+        for name in names:
+            try:
+                entries = self.index.under('/'.join(split_relpath(name)))
+            except ValueError:
+                entries = []
+            if entries:
+                selected.extend(entries)
+            else:
+                missing.append(name)
+        writer.write(struct.pack('!IQ', len(selected), sum(e.size for e in selected)))
+        for name in missing: writer.write(pack_string(name) + b'\x00')
+        for entry in selected:
+            try:
+                f = open(self._upload_path(entry.name), 'rb')
+            except (OSError, ValueError):
+                writer.write(pack_string(entry.name) + b'\x00')
+                continue
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                writer.write(pack_string(entry.name) + b'\x01' + struct.pack('!Q', size))
+                await self._drain(writer)
+                writer.write(await self._send_with_digest(writer, f, entry.name, 0, size))
+        writer.write(pack_string(''))
+        await self._drain(writer)
+        return True
+
+    async def _handle_have(self, reader, writer):
+        # Dedupe before an upload: the client names the file, its size and SHA-256. If some
+        # stored file has exactly that content it is linked (or copied) into place and the
+        # reply is OK, so no data needs to be sent; otherwise NF.
+        fn = await self._read_filename(reader)
+        size, digest = struct.unpack(f'!Q{DIGEST_SIZE}s', await self._read(reader, 8 + DIGEST_SIZE))
+        try:
+            fp = self._upload_path(fn)
+            await self._refresh_index()
+            source = self.index.find_content(size, digest)
+            if source is None:
+                writer.write(STATUS_NOT_FOUND)
+                await self._drain(writer)
+                return True
+            if source.name != self._index_name(fp):
+                before = await asyncio.get_running_loop().run_in_executor(
+                    None, self._clone, os.path.join(self.uploads_dir, *source.name.split('/')), fp,
+                    self._staging_path(fn, os.urandom(8).hex()))
+                self._changed(fp, digest, before)
+        except (OSError, ValueError) as e:
+            self.log(f"Could not reuse stored content for {fn}: {e}", 'error')
+            await self._reply(writer, False)
+            return True
+        return await self._reply(writer, True)
+
+    def _clone(self, source, fp, staging):
+        # Uploads always replace files rather than write into them, so a hard link is safe;
+        # fall back to a copy across filesystems or where links aren't supported.
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        try:
+            try:
+                os.link(source, staging)
+            except OSError:
+                shutil.copyfile(source, staging)
+            return self._replace(staging, fp)
+        finally:
+            if os.path.exists(staging): os.remove(staging)
+
+    async def _handle_stats(self, reader, writer):
+        # The metrics in Prometheus text format, length-prefixed.
+        text = self.metrics.render().encode('utf-8')
+        self.scheduler.charge(_peer.get(), len(text))
+        writer.write(struct.pack('!I', len(text)) + text)
+        await self._drain(writer)
+        return True
+
+    async def _handle_codecs(self, reader, writer):
+        # The client offers codecs in order of preference; reply with the first one shared.
+        count = (await self._read(reader, 1))[0]
+        offered = await self._read(reader, count)
+        writer.write(bytes([choose_codec(offered)]))
+        await self._drain(writer)
+        return True
+
+    async def _handle_download(self, reader, writer):
+        # Streams `length` bytes from `offset` (length 0 means to the end of the file),
+        # as compression frames when a codec is given. The whole file's SHA-256 follows the
+        # data for the client to check once it has all of it, or for a range asked for by
+        # length (a stripe) that range's own SHA-256, so it can be checked on arrival. The
+        # reply header carries the file's SHA-256 when the index already knows it (otherwise
+        # NO_DIGEST).
+        fn = await self._read_filename(reader)
+        offset, length = struct.unpack('!QQ', await self._read(reader, 16))
+        try:
+            codec = await self._read_codec(reader)
+        except ValueError:
+            writer.write(STATUS_ERROR)
+            await self._drain(writer)
+            return True
+        try:
+            f = open(self._upload_path(fn), 'rb')
+        except (OSError, ValueError):
+            writer.write(STATUS_NOT_FOUND)
+            await self._drain(writer)
+            return True
+        with f:
+            fs = os.fstat(f.fileno()).st_size
+            start = min(offset, fs)
+            count = fs - start if length == 0 else min(length, fs - start)
+            name = self._index_name(f.name)
+            try:
+                entry = self._current_entry(name)
+            except OSError:
+                entry = None
+            writer.write(STATUS_OK + struct.pack('!QQ', fs, count) + (entry and entry.digest or NO_DIGEST))
+            await self._drain(writer)
+            writer.write(await self._send_with_digest(writer, f, name, start, count, codec, whole=not length))
+            await self._drain(writer)
+        return True
+
+    async def _send_with_digest(self, writer, f, name, offset, count, codec=CODEC_NONE, whole=True):
+        # Sends a range of stored file `name` and returns the file's SHA-256 (or without
+        # `whole`, the range's) to follow it, or NO_DIGEST for an empty range. A digest the
+        # index lacks is worked out on an executor while the range goes out, so hashing never
+        # holds up the first byte.
+        if not count: return NO_DIGEST
+        hashing = asyncio.ensure_future(self._file_digest(name) if whole else self._range_digest(f, name, offset, count))
+        try:
+            await self._send_range(writer, f, offset, count, codec)
+        except BaseException:
+            self._settle(hashing)
+            raise
+        try:
+            return await hashing
+        except OSError:
+            return NO_DIGEST
+
+    async def _range_digest(self, f, name, offset, count):
+        # Stripes of a file fall on the same boundaries each time it is downloaded, so the
+        # digests of recent ranges are kept for as long as the file is unchanged.
+        st = os.fstat(f.fileno())
+        key = (name, st.st_size, st.st_mtime_ns, offset, count)
+        digest = self._range_digests.get(key)
+        if digest is None:
+            digest = await asyncio.get_running_loop().run_in_executor(None, hash_file, f.name, 1024 * 1024, count, offset)
+            if len(self._range_digests) >= RANGE_DIGESTS: del self._range_digests[next(iter(self._range_digests))]
+            self._range_digests[key] = digest
+        return digest
+
+    async def _send_range(self, writer, f, offset, count, codec=CODEC_NONE):
+        if not count: return
+        view = await self._cached(f) if self.file_cache and (self.use_ssl or codec != CODEC_NONE) else None
+        if codec != CODEC_NONE:
+            await self._send_frames(writer, f, offset, count, codec, view)
+            return
+        if not self.use_ssl:
+            loop = asyncio.get_running_loop()
+            if not self.scheduler.limited:
+                writer.count(count)
+                await loop.sendfile(writer.transport, f, offset, count)
+                return
+            # Throttled: one quantum at a time so other transfers get their turn in between.
+            while count:
+                n = min(self.scheduler.quantum, count)
+                await self.scheduler.throttle(_peer.get(), n)
+                writer.count(n)
+                await loop.sendfile(writer.transport, f, offset, n)
+                offset += n
+                count -= n
+            return
+        # TLS can't use the kernel sendfile path; drain per chunk so a vanished peer stops the loop.
+        if view is not None:
+            # Slices of the cached file: nothing is read or copied per request.
+            while count:
+                n = min(self.buffer_size, count)
+                await self.scheduler.throttle(_peer.get(), n)
+                writer.write(view[offset:offset + n])
+                offset += n
+                count -= n
+                await self._drain(writer)
+            return
+        f.seek(offset)
+        while count:
+            chunk = f.read(min(self.buffer_size, count))
+            if not chunk: raise OSError("File shrank while sending.")
+            await self.scheduler.throttle(_peer.get(), len(chunk))
+            writer.write(chunk)
+            count -= len(chunk)
+            await self._drain(writer)
+
+    async def _send_frames(self, writer, f, offset, count, codec, view=None):
+        # Frame n + 1 is read (or sliced from the cached `view`) and compressed on an executor
+        # thread while frame n is sent.
+        loop = asyncio.get_running_loop()
+        encoder = FrameEncoder(codec)
+        f.seek(offset)
+
+        def next_frame(pos, size):
+            raw = view[pos:pos + size] if view is not None else f.read(size)
+            if len(raw) != size: raise OSError("File shrank while sending.")
+            return encoder.encode(raw)
+
+        frames = [(pos, min(FRAME_SIZE, offset + count - pos)) for pos in range(offset, offset + count, FRAME_SIZE)]
+        pending = loop.run_in_executor(None, next_frame, *frames[0])
+        try:
+            for i in range(len(frames)):
+                header, payload = await pending
+                if i + 1 < len(frames): pending = loop.run_in_executor(None, next_frame, *frames[i + 1])
+                await self.scheduler.throttle(_peer.get(), len(header) + len(payload))
+                writer.write(header)
+                writer.write(payload)
+                await self._drain(writer)
+        finally:
+            self._settle(pending)
@@ -0,0 +1,176 @@
+import multiprocessing
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+
+from dir_index import HASH_INDEX_SUFFIX
+from server_engine import ServerEngine
+
+# Worker generations are spaced this far apart so a listing generation handed out by
+# one worker never falls inside another worker's range (see DirectoryIndex.changes_since).
+GENERATION_SPACING = 1 << 40
+
+
+def listening_sockets(host, port, count, backlog):
+    """One SO_REUSEPORT socket per worker on Linux, where the kernel spreads new
+    connections across them, otherwise a single socket shared by every worker."""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    reuse_port = count > 1 and sys.platform.startswith('linux') and hasattr(socket, 'SO_REUSEPORT')
+    first = socket.create_server((host, port), family=family, backlog=backlog, reuse_port=reuse_port)
+    if not reuse_port: return [first] * count
+    port = first.getsockname()[1]
+    socks = [first]
+    try:
+        for _ in range(count - 1):
+            socks.append(socket.create_server((host, port), family=family, backlog=backlog, reuse_port=True))
+    except OSError:
+        for s in socks: s.close()
+        raise
+    return socks
+
+
+def _run_worker(worker_id, options, sock, inbox, events):
+    # Entry point of a worker process: one ServerEngine on the inherited socket. Index
+    # changes go out through `events` and other workers' changes come in through `inbox`.
+    engine = ServerEngine(**options, sock=sock, first_generation=time.time_ns() + worker_id * GENERATION_SPACING,
+                          metrics_labels={'worker': worker_id},
+                          log=lambda message, log_type='info': events.put(('log', worker_id, (message, log_type))),
+                          on_change=lambda name, entry: events.put(('change', worker_id, (name, entry))))
+    ready, errors = threading.Event(), []
+
+    def listen():
+        ready.wait()
+        if errors:
+            events.put(('error', worker_id, f"{type(errors[0]).__name__}: {errors[0]}"))
+            return
+        events.put(('ready', worker_id, None))
+        while True:
+            change = inbox.get()
+            if change is None: break
+            engine.apply_change(*change)
+        engine.stop()
+
+    threading.Thread(target=listen, daemon=True).start()
+    engine.run(ready, errors)
+
+
+# --- Multi-process server ---
+class ServerPool:
+    """Runs `workers` ServerEngine processes on one port, so TLS encryption and the rest
+    of the per-connection work spread across CPU cores.
+
+    Each worker serves whole sessions on its own. Uploads one worker finishes are relayed
+    to the others so every LIST sees them; a client whose pooled connection lands on a
+    different worker gets a full listing instead of an incremental one, and a TLS session
+    from one worker can't be resumed on another (it falls back to a full handshake).
+    `rate_limit` is split evenly between the workers; `client_rate_limit` applies per
+    worker. Each worker keeps its own metrics (STAT reports the worker that answers) and
+    writes them to `metrics_file` with its number inserted ('x.prom' -> 'x.0.prom'); the
+    same goes for its saved file digests. Digests of uploads are relayed with them.
+    `cache_size` is per worker; on POSIX the cached files are shared mappings, so workers
+    caching the same file share its memory.
+    Same start/stop/port interface as ServerEngine.
+    """
+
+    def __init__(self, workers, port, uploads_dir, use_ssl=False, certfile='cert.pem', keyfile='key.pem', host='',
+                 backlog=128, max_connections=256, idle_timeout=300.0, buffer_size=65536, log=None,
+                 rate_limit=0, client_rate_limit=0, metrics_file=None, metrics_interval=15.0,
+                 cache_size=256 * 1024 * 1024, start_timeout=30.0):
+        self.workers = max(1, workers)
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.start_timeout = start_timeout
+        self._log = log
+        self._options = dict(port=port, uploads_dir=uploads_dir, use_ssl=use_ssl, certfile=certfile,
+                             keyfile=keyfile, host=host, idle_timeout=idle_timeout, buffer_size=buffer_size,
+                             max_connections=-(-max_connections // self.workers),
+                             rate_limit=rate_limit / self.workers, client_rate_limit=client_rate_limit,
+                             metrics_interval=metrics_interval, cache_size=cache_size)
+        self.digests_file = os.path.normpath(os.path.abspath(uploads_dir)) + HASH_INDEX_SUFFIX
+        self.metrics_file = metrics_file
+        self._processes = []
+        self._inboxes = []
+        self._events = None
+        self._relay = None
+
+    def log(self, message, log_type='info'):
+        if self._log: self._log(message, log_type)
+
+    # --- Lifecycle ---
+    def start(self):
+        ctx = multiprocessing.get_context('spawn')
+        socks = listening_sockets(self.host, self.port, self.workers, self.backlog)
+        self.port = socks[0].getsockname()[1]
+        self._events = ctx.Queue()
+        try:
+            for worker_id, sock in enumerate(socks):
+                inbox = ctx.Queue()
+                options = dict(self._options, metrics_file=self._worker_file(self.metrics_file, worker_id),
+                               digests_file=self._worker_file(self.digests_file, worker_id))
+                process = ctx.Process(target=_run_worker, args=(worker_id, options, sock, inbox, self._events),
+                                      name=f'server-worker-{worker_id}', daemon=True)
+                process.start()
+                self._processes.append(process)
+                self._inboxes.append(inbox)
+        finally:
+            # The workers hold their own copies now.
+            for sock in set(socks): sock.close()
+        try:
+            self._wait_ready()
+        except BaseException:
+            self.stop()
+            raise
+        self._relay = threading.Thread(target=self._relay_events, daemon=True)
+        self._relay.start()
+
+    @staticmethod
+    def _worker_file(path, worker_id):
+        if not path: return None
+        root, ext = os.path.splitext(path)
+        return f"{root}.{worker_id}{ext}"
+
+    def _wait_ready(self):
+        deadline = time.monotonic() + self.start_timeout
+        pending = set(range(len(self._processes)))
+        while pending:
+            try:
+                kind, worker_id, detail = self._events.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                raise TimeoutError(f"{len(pending)} of {self.workers} server workers did not start") from None
+            if kind == 'error': raise OSError(f"Server worker {worker_id} failed to start: {detail}")
+            if kind == 'ready':
+                pending.discard(worker_id)
+            else:
+                self._dispatch(kind, worker_id, detail)
+
+    def _relay_events(self):
+        while True:
+            event = self._events.get()
+            if event is None: break
+            self._dispatch(*event)
+
+    def _dispatch(self, kind, worker_id, detail):
+        if kind == 'log':
+            self.log(*detail)
+        elif kind == 'change':
+            for i, inbox in enumerate(self._inboxes):
+                if i != worker_id: inbox.put(detail)
+        elif kind == 'error':
+            self.log(f"Server worker {worker_id} stopped: {detail}", 'error')
+
+    def stop(self, timeout=5.0):
+        for inbox in self._inboxes: inbox.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+                process.join(1.0)
+        if self._relay:
+            self._events.put(None)
+            self._relay.join(timeout)
+        self._processes, self._inboxes, self._relay = [], [], None
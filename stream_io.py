@@ -0,0 +1,149 @@
+import errno
+import os
+import select
+import socket
+import ssl
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Bounds for the adaptive transfer chunk size.
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+
+_local = threading.local()
+
+
+def _buffer():
+    # One MAX_CHUNK buffer per thread, reused by every transfer that thread runs.
+    view = getattr(_local, 'view', None)
+    if view is None: view = _local.view = memoryview(bytearray(MAX_CHUNK))
+    return view
+
+
+# --- Adaptive chunk sizing ---
+class ChunkSizer:
+    """Picks power-of-two chunk sizes between `low` and `high` so that one chunk takes
+    about `target` seconds at the throughput measured so far (smoothed)."""
+
+    def __init__(self, initial=MIN_CHUNK, low=MIN_CHUNK, high=MAX_CHUNK, target=0.02):
+        self.low, self.high, self.target = low, high, target
+        self.size = min(max(initial, low), high)
+        self.rate = None
+
+    def record(self, nbytes, seconds):
+        rate = nbytes / max(seconds, 1e-6)
+        self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+        size = self.low
+        while size < self.rate * self.target and size < self.high: size *= 2
+        self.size = min(size, self.high)
+
+
+def preallocate(f, size):
+    # Reserve `size` bytes for `f` up front (contents already there are kept); falls back
+    # to extending the file where the OS or filesystem has no fallocate.
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass  # filesystem without fallocate support
+    if size > os.fstat(f.fileno()).st_size: f.truncate(size)
+
+
+# --- Socket <-> file copies ---
+def _can_splice(sock, f):
+    return hasattr(os, 'splice') and not isinstance(sock, ssl.SSLSocket) and hasattr(f, 'fileno')
+
+
+def _wait_readable(sock):
+    # Sockets with a timeout are non-blocking underneath, so splice() can return EAGAIN.
+    if not select.select([sock], [], [], sock.gettimeout())[0]: raise socket.timeout("timed out")
+
+
+def _splice_into_file(sock, f, count, sizer, on_chunk):
+    # socket -> pipe -> file entirely in the kernel; the data never reaches Python. Returns
+    # False, having moved nothing, if the kernel refuses to splice from this socket.
+    f.flush()
+    fd, pos = f.fileno(), f.tell()
+    r, w = os.pipe()
+    try:
+        pipe_size = 64 * 1024
+        if fcntl and hasattr(fcntl, 'F_SETPIPE_SZ'):
+            try:
+                fcntl.fcntl(w, fcntl.F_SETPIPE_SZ, 1024 * 1024)
+            except OSError:
+                pass  # above /proc/sys/fs/pipe-max-size
+            pipe_size = fcntl.fcntl(w, fcntl.F_GETPIPE_SZ)
+        left = count
+        while left:
+            want, done, started = min(sizer.size, left), 0, time.perf_counter()
+            while done < want:
+                try:
+                    n = os.splice(sock.fileno(), w, min(want - done, pipe_size))
+                except BlockingIOError:
+                    _wait_readable(sock)
+                    continue
+                except OSError as e:
+                    if left == count and not done and e.errno in (errno.EINVAL, errno.ENOSYS): return False
+                    raise
+                if n == 0: raise ConnectionError("Connection closed by peer.")
+                while n:
+                    moved = os.splice(r, fd, n, offset_dst=pos)
+                    pos += moved
+                    done += moved
+                    n -= moved
+            sizer.record(want, time.perf_counter() - started)
+            left -= want
+            if on_chunk: on_chunk(want)
+        return True
+    finally:
+        os.close(r)
+        os.close(w)
+        f.seek(pos)
+
+
+def receive_into_file(sock, f, count, sizer, on_chunk=None, digest=None):
+    """Write exactly `count` bytes from `sock` to `f` at its current position, calling
+    `on_chunk(n)` after each chunk and feeding the data to `digest` (a hashlib object).
+    Plain TCP sockets use splice() where the OS has it, unless the data must be hashed;
+    otherwise chunks are received into a reused per-thread buffer."""
+    if count and digest is None and _can_splice(sock, f) and _splice_into_file(sock, f, count, sizer, on_chunk):
+        return
+    view = _buffer()
+    left = count
+    while left:
+        want, done, started = min(sizer.size, left), 0, time.perf_counter()
+        while done < want:
+            n = sock.recv_into(view[done:want])
+            if n == 0: raise ConnectionError("Connection closed by peer.")
+            done += n
+        f.write(view[:want])
+        if digest: digest.update(view[:want])
+        sizer.record(want, time.perf_counter() - started)
+        left -= want
+        if on_chunk: on_chunk(want)
+
+
+def send_from_file(sock, f, offset, count, sizer, on_chunk=None):
+    """Send `count` bytes of `f` starting at `offset`, calling `on_chunk(n)` after each
+    chunk. Plain TCP sockets use sendfile(); TLS sockets read into a reused buffer."""
+    plain = not isinstance(sock, ssl.SSLSocket)
+    view = None if plain else _buffer()
+    f.seek(offset)
+    left = count
+    while left:
+        want, started = min(sizer.size, left), time.perf_counter()
+        if plain:
+            n = sock.sendfile(f, offset + count - left, want)
+        else:
+            n = f.readinto(view[:want])
+            sock.sendall(view[:n])
+        if n < want: raise OSError("File shrank while sending.")
+        sizer.record(want, time.perf_counter() - started)
+        left -= want
+        if on_chunk: on_chunk(want)
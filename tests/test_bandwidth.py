@@ -0,0 +1,39 @@
+import pytest
+
+import bandwidth
+from bandwidth import TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bandwidth.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_burst_is_free(clock):
+    bucket = TokenBucket(1000, burst=500)
+    assert bucket.reserve(500) == 0.0
+
+
+def test_debt_is_waited_off_in_arrival_order(clock):
+    bucket = TokenBucket(1000, burst=500)
+    assert bucket.reserve(500) == 0.0
+    assert bucket.reserve(250) == pytest.approx(0.25)
+    assert bucket.reserve(250) == pytest.approx(0.5)
+
+
+def test_refills_at_rate_up_to_burst(clock):
+    bucket = TokenBucket(1000, burst=500)
+    bucket.reserve(1000)
+    clock[0] += 0.5
+    assert bucket.reserve(0) == 0.0
+    assert not bucket.idle
+    clock[0] += 10
+    assert bucket.idle
+    assert bucket.reserve(600) == pytest.approx(0.1)
+
+
+def test_default_burst():
+    assert TokenBucket(1000).burst == 64 * 1024
+    assert TokenBucket(4 * 1024 * 1024).burst == 1024 * 1024
@@ -0,0 +1,82 @@
+import os
+import tracemalloc
+import zlib
+
+import pytest
+
+from compression import (CODEC_ZLIB, CODECS, FRAME_COMPRESSED, FRAME_HEADER, FRAME_STORED, MAX_FRAME_SIZE, FrameEncoder,
+                         decode_frame, read_frame_header, supported_codecs)
+
+TEXT = b'the quick brown fox jumps over the lazy dog\n' * 2000
+
+
+def round_trip(encoder, codec, raw):
+    header, payload = encoder.encode(raw)
+    flag, raw_len, wire_len = read_frame_header(header)
+    assert wire_len == len(payload)
+    return flag, decode_frame(codec, flag, raw_len, payload)
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_compressible_frames_round_trip(codec):
+    flag, data = round_trip(FrameEncoder(codec), codec, TEXT)
+    assert flag == FRAME_COMPRESSED and data == TEXT
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_incompressible_frames_are_stored(codec):
+    raw = os.urandom(64 * 1024)
+    flag, data = round_trip(FrameEncoder(codec), codec, raw)
+    assert flag == FRAME_STORED and data == raw
+
+
+def test_encoder_stops_trying_after_misses():
+    encoder = FrameEncoder(supported_codecs()[0], give_up=2, skip=3)
+    calls = []
+    compress = encoder.compress
+    encoder.compress = lambda data: calls.append(1) or compress(data)
+    for _ in range(5): encoder.encode(os.urandom(4096))
+    assert len(calls) == 2
+    encoder.encode(TEXT)
+    assert len(calls) == 3
+
+
+def test_wrong_length_is_rejected():
+    codec = supported_codecs()[0]
+    header, payload = FrameEncoder(codec).encode(TEXT)
+    with pytest.raises(ValueError):
+        decode_frame(codec, FRAME_COMPRESSED, len(TEXT) - 1, payload)
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_frames_of_exactly_the_declared_length(codec):
+    for raw in (b'a', b'a' * MAX_FRAME_SIZE, TEXT[:MAX_FRAME_SIZE]):
+        assert decode_frame(codec, FRAME_COMPRESSED, len(raw), CODECS[codec][0](raw)) == raw
+
+
+def test_decompression_stops_at_the_declared_length():
+    bomb = zlib.compress(bytes(64 * 1024 * 1024), 9)
+    tracemalloc.start()
+    try:
+        with pytest.raises(ValueError):
+            decode_frame(CODEC_ZLIB, FRAME_COMPRESSED, 1024, bomb)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 1024 * 1024
+
+
+def test_trailing_and_corrupt_data_is_rejected():
+    payload = zlib.compress(TEXT)
+    for bad in (payload + b'junk', payload[:-5], b'garbage'):
+        with pytest.raises(ValueError):
+            decode_frame(CODEC_ZLIB, FRAME_COMPRESSED, len(TEXT), bad)
+    with pytest.raises(ValueError):
+        decode_frame(CODEC_ZLIB, FRAME_COMPRESSED, MAX_FRAME_SIZE + 1, payload)
+
+
+def test_malformed_headers_are_rejected():
+    with pytest.raises(ValueError):
+        read_frame_header(FRAME_HEADER.pack(7, 10, 10))
+    with pytest.raises(ValueError):
+        read_frame_header(FRAME_HEADER.pack(FRAME_COMPRESSED, 64 * 1024 * 1024, 10))
@@ -0,0 +1,78 @@
+import random
+import zlib
+
+import pytest
+
+from delta import OP_BLOCKS, OP_LITERAL, block_signatures, compute_delta, roll, strong_hash
+
+BLOCK = 8192
+
+
+def signatures(data):
+    return [(zlib.adler32(data[i:i + BLOCK]), strong_hash(data[i:i + BLOCK])) for i in range(0, len(data), BLOCK)]
+
+
+def rebuild(ops, data, basis):
+    out, start = bytearray(), 0
+    for op, a, end in ops:
+        out += data[a:end] if op == OP_LITERAL else basis[a * BLOCK:a * BLOCK + end - start]
+        start = end
+    return bytes(out)
+
+
+def literal_bytes(ops):
+    return sum(end - start for op, start, end in ops if op == OP_LITERAL)
+
+
+def test_roll_matches_adler32():
+    data = random.Random(1).randbytes(3 * BLOCK)
+    weak = zlib.adler32(data[:BLOCK])
+    for pos in range(2 * BLOCK):
+        weak = roll(weak, data[pos], data[pos + BLOCK], BLOCK)
+        assert weak == zlib.adler32(data[pos + 1:pos + 1 + BLOCK])
+
+
+def test_signatures_of_file(tmp_path):
+    data = random.Random(2).randbytes(3 * BLOCK + 100)
+    path = tmp_path / 'basis'
+    path.write_bytes(data)
+    assert block_signatures(str(path), BLOCK) == signatures(data)
+
+
+def test_unchanged_file_is_all_blocks():
+    basis = random.Random(3).randbytes(16 * BLOCK + 123)
+    ops = list(compute_delta(basis, signatures(basis), BLOCK, len(basis)))
+    assert literal_bytes(ops) == 0
+    assert rebuild(ops, basis, basis) == basis
+
+
+@pytest.mark.parametrize('at', [3 * BLOCK, 3 * BLOCK + 100, 40 * BLOCK + 4001])
+@pytest.mark.parametrize('length', [7, 1000, BLOCK + 808, 5 * BLOCK + 3])
+def test_insertion_round_trip(at, length):
+    rng = random.Random(at * 31 + length)
+    basis = rng.randbytes(64 * BLOCK)
+    data = basis[:at] + rng.randbytes(length) + basis[at:]
+    ops = list(compute_delta(data, signatures(basis), BLOCK, len(basis)))
+    assert rebuild(ops, data, basis) == data
+    # The block the insertion lands in is resent; the search must realign right after it.
+    assert literal_bytes(ops) <= 2 * (length + BLOCK)
+
+
+@pytest.mark.parametrize('length', [7, 3 * BLOCK + 5])
+def test_deletion_round_trip(length):
+    rng = random.Random(length)
+    basis = rng.randbytes(64 * BLOCK)
+    at = 10 * BLOCK + 333
+    data = basis[:at] + basis[at + length:]
+    ops = list(compute_delta(data, signatures(basis), BLOCK, len(basis)))
+    assert rebuild(ops, data, basis) == data
+    assert literal_bytes(ops) <= 2 * BLOCK
+
+
+def test_short_tail_block_is_reused_only_at_the_end():
+    rng = random.Random(5)
+    basis = rng.randbytes(4 * BLOCK + 100)
+    data = rng.randbytes(50) + basis
+    ops = list(compute_delta(data, signatures(basis), BLOCK, len(basis)))
+    assert rebuild(ops, data, basis) == data
+    assert ops[-1] == (OP_BLOCKS, 4, len(data))
@@ -0,0 +1,78 @@
+import hashlib
+import os
+
+from dir_index import DirectoryIndex
+
+
+def write(root, name, data=b'x'):
+    path = os.path.join(root, *name.split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f: f.write(data)
+
+
+def test_full_listing_for_unknown_generations(tmp_path):
+    root = str(tmp_path / 'uploads')
+    write(root, 'a.txt')
+    write(root, 'sub/b.txt')
+    index = DirectoryIndex(root, first_generation=100)
+    for since in (0, 99, index.generation + 1):
+        full, entries, removed = index.changes_since(since)
+        assert full and [e.name for e in entries] == ['a.txt', 'sub/b.txt'] and removed == []
+
+
+def test_changes_since_reports_updates_and_removals(tmp_path):
+    root = str(tmp_path / 'uploads')
+    write(root, 'a.txt')
+    write(root, 'b.txt')
+    index = DirectoryIndex(root, first_generation=100)
+    since = index.generation
+    assert index.changes_since(since) == (False, [], [])
+    write(root, 'c.txt')
+    index.update('c.txt')
+    os.remove(os.path.join(root, 'a.txt'))
+    index.update('a.txt')
+    full, entries, removed = index.changes_since(since)
+    assert not full
+    assert [e.name for e in entries] == ['c.txt']
+    assert removed == ['a.txt']
+    assert index.changes_since(index.generation) == (False, [], [])
+
+
+def test_forgotten_removals_fall_back_to_a_full_listing(tmp_path):
+    root = str(tmp_path / 'uploads')
+    for i in range(3): write(root, f'{i}.txt')
+    index = DirectoryIndex(root, max_removed=2, first_generation=100)
+    since = index.generation
+    for i in range(3):
+        os.remove(os.path.join(root, f'{i}.txt'))
+        index.update(f'{i}.txt')
+    full, entries, removed = index.changes_since(since)
+    assert full and entries == [] and removed == []
+
+
+def test_digests_saved_by_each_process_are_all_loaded(tmp_path):
+    root = str(tmp_path / 'uploads')
+    write(root, 'a.txt', b'a')
+    write(root, 'b.txt', b'b')
+    first = DirectoryIndex(root, digests_file=root + '.hashes.0.json')
+    second = DirectoryIndex(root, digests_file=root + '.hashes.1.json')
+    first.set_digest(first.entries['a.txt'], hashlib.sha256(b'a').digest())
+    second.set_digest(second.entries['b.txt'], hashlib.sha256(b'b').digest())
+    first.save_digests()
+    second.save_digests()
+    index = DirectoryIndex(root)
+    assert index.entries['a.txt'].digest == hashlib.sha256(b'a').digest()
+    assert index.entries['b.txt'].digest == hashlib.sha256(b'b').digest()
+    assert index.find_content(1, hashlib.sha256(b'b').digest()).name == 'b.txt'
+
+
+def test_rescan_picks_up_outside_changes(tmp_path):
+    root = str(tmp_path / 'uploads')
+    write(root, 'a.txt')
+    index = DirectoryIndex(root, rescan_interval=0, first_generation=100)
+    since = index.generation
+    write(root, 'outside.txt')
+    os.utime(root, ns=(0, os.stat(root).st_mtime_ns + 1))
+    index.refresh()
+    full, entries, removed = index.changes_since(since)
+    assert not full and [e.name for e in entries] == ['outside.txt']
@@ -0,0 +1,621 @@
+import functools
+import hashlib
+import json
+import mmap
+import os
+import select
+import socket
+import ssl
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from compression import (CODEC_NONE, FRAME_SIZE, FrameEncoder, decode_frame, read_frame_header,
+                         supported_codecs)
+from delta import OP_BLOCKS, OP_END, OP_LITERAL, SIGNATURE_SIZE, compute_delta, unpack_signatures
+from dir_index import hash_file, hash_prefix
+from protocol import (CMD_ABORT, CMD_BATCH_DOWNLOAD, CMD_BATCH_UPLOAD, CMD_CODECS, CMD_COMMIT, CMD_DELTA, CMD_DOWNLOAD,
+                      CMD_HAVE, CMD_LIST, CMD_PART, CMD_RESUME, CMD_SIGNATURES, CMD_STATS, CMD_STRIPES, CMD_UPLOAD,
+                      DIGEST_SIZE, LIST_WITH_HASHES, NO_DIGEST, PARTIAL_SUFFIX, STATUS_NOT_FOUND, STATUS_OK, pack_string,
+                      recv_exactly, recv_string, split_relpath, unpack_page)
+from stream_io import ChunkSizer, preallocate, receive_into_file, send_from_file
+
+# A download range starting past the end of the file returns just the file size.
+END_OF_FILE = 0xFFFFFFFFFFFFFFFF
+# Progress of an interrupted striped download, stored next to its .part file.
+STRIPES_SUFFIX = '.stripes'
+# Striped downloads fetch each stripe in requests of at most this many bytes, each checked
+# against its SHA-256 on arrival; an interrupted download keeps only what was checked.
+STRIPE_REQUEST_SIZE = 64 * 1024 * 1024
+# Batch transfers coalesce small files into sends of about this size.
+BATCH_SEND_SIZE = 256 * 1024
+
+
+def expand_paths(paths):
+    """Return (local path, relative name) for every file in `paths`; a directory
+    contributes all files below it, named relative to its parent."""
+    files = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            files.append((path, os.path.basename(path)))
+            continue
+        parent = os.path.dirname(path)
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                fp = os.path.join(root, name)
+                files.append((fp, os.path.relpath(fp, parent).replace(os.sep, '/')))
+    return files
+
+
+# --- Client-side connection pool ---
+class ConnectionPool:
+    """Keeps idle session connections to one server for reuse.
+
+    New TLS connections offer the most recent session ticket so the server can
+    resume the session instead of running a full handshake.
+    """
+
+    def __init__(self, host, port, use_ssl=False, max_idle=4, idle_ttl=60.0, timeout=30.0):
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.idle_ttl = idle_ttl
+        self.timeout = timeout
+        self.handshakes = 0
+        self.resumed_handshakes = 0
+        self._ssl_context = None
+        if use_ssl:
+            self._ssl_context = ssl.create_default_context()
+            self._ssl_context.check_hostname = False
+            self._ssl_context.verify_mode = ssl.CERT_NONE
+        self._tls_session = None
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if not self._ssl_context: return sock
+        try:
+            conn = self._ssl_context.wrap_socket(sock, server_hostname=self.host, session=self._tls_session)
+        except Exception:
+            sock.close()
+            raise
+        self.handshakes += 1
+        if conn.session_reused: self.resumed_handshakes += 1
+        return conn
+
+    def _is_alive(self, conn):
+        # An idle session has nothing to read; readable means the server closed it.
+        try:
+            readable, _, _ = select.select([conn], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def acquire(self):
+        """Return (conn, reused) with a pooled connection when a live one is available."""
+        with self._lock:
+            while self._idle:
+                conn, released_at = self._idle.pop()
+                if time.monotonic() - released_at < self.idle_ttl and self._is_alive(conn): return conn, True
+                conn.close()
+        return self._connect(), False
+
+    def release(self, conn, reusable=True):
+        # TLS 1.3 tickets arrive after the handshake, so pick up the session on the way back.
+        session = getattr(conn, 'session', None)
+        if session is not None and getattr(session, 'has_ticket', True): self._tls_session = session
+        with self._lock:
+            if reusable and len(self._idle) < self.max_idle:
+                self._idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        conn, _ = self.acquire()
+        try:
+            yield conn
+        except BaseException:
+            self.release(conn, False)
+            raise
+        self.release(conn)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle: conn.close()
+
+
+# --- Protocol client ---
+class TransferClient:
+    """Runs UPLD/DNLD/LIST over pooled session connections (no GUI dependency).
+
+    Files of at least `stripe_threshold` bytes are split into `streams` byte ranges
+    that move over concurrent connections. With `delta_sync`, re-uploading a file the
+    server already has sends only the blocks that changed. With `compression`, single-stream
+    uploads and downloads use the best codec both sides support.
+
+    Every transfer is checked against the file's SHA-256, and an upload whose content the
+    server already stores (under any name) completes without sending the data.
+    """
+
+    def __init__(self, host, port, use_ssl=False, buffer_size=8192, pool_size=4, timeout=30.0, streams=1,
+                 stripe_threshold=64 * 1024 * 1024, delta_sync=False, compression=False):
+        self.buffer_size = buffer_size
+        self.delta_sync = delta_sync
+        self.compression = compression
+        self._codec = None
+        self.streams = max(1, streams)
+        self.stripe_threshold = stripe_threshold
+        self.pool = ConnectionPool(host, port, use_ssl, max_idle=max(pool_size, self.streams), timeout=timeout)
+        # Local copy of the server's listing, kept current by refresh_listing().
+        self.remote_index = {}
+        self.listing_generation = 0
+        self._listing_has_hashes = False
+        self._listing_lock = threading.Lock()
+        # path -> (size, mtime_ns, SHA-256) of local files hashed for upload.
+        self._digests = {}
+
+    def close(self):
+        self.pool.close()
+
+    def _request(self, operation):
+        # A pooled connection can be closed by the server's idle timeout at any moment;
+        # retry once on a fresh connection when that happens.
+        conn, reused = self.pool.acquire()
+        try:
+            result = operation(conn)
+        except (ConnectionError, ssl.SSLEOFError):
+            self.pool.release(conn, False)
+            if not reused: raise
+            conn, _ = self.pool.acquire()
+            try:
+                result = operation(conn)
+            except BaseException:
+                self.pool.release(conn, False)
+                raise
+        except BaseException:
+            self.pool.release(conn, False)
+            raise
+        self.pool.release(conn)
+        return result
+
+    def list_files(self):
+        return sorted(self.refresh_listing())
+
+    def refresh_listing(self, with_hashes=False, page_size=500):
+        """Update `remote_index` (name -> FileEntry) with the entries that changed since the
+        last call and return a copy of it."""
+        def operation(conn):
+            since = self.listing_generation
+            if with_hashes and not self._listing_has_hashes: since = 0
+            conn.sendall(CMD_LIST + struct.pack('!QIB', since, page_size, LIST_WITH_HASHES if with_hashes else 0))
+            pages = []
+            while True:
+                size = struct.unpack('!I', recv_exactly(conn, 4))[0]
+                if size == 0: break
+                pages.append(unpack_page(recv_exactly(conn, size)))
+            generation, full = struct.unpack('!Q?', recv_exactly(conn, 9))
+            with self._listing_lock:
+                if full: self.remote_index = {}
+                if full or not with_hashes: self._listing_has_hashes = with_hashes
+                for entries, removed in pages:
+                    for entry in entries: self.remote_index[entry.name] = entry
+                    for name in removed: self.remote_index.pop(name, None)
+                self.listing_generation = generation
+                return dict(self.remote_index)
+        return self._request(operation)
+
+    def server_stats(self):
+        """The server's metrics in Prometheus text format."""
+        def operation(conn):
+            conn.sendall(CMD_STATS)
+            return recv_exactly(conn, struct.unpack('!I', recv_exactly(conn, 4))[0]).decode('utf-8')
+        return self._request(operation)
+
+    # --- Integrity ---
+    def _local_digest(self, fp):
+        st = os.stat(fp)
+        cached = self._digests.get(fp)
+        if cached and cached[:2] == (st.st_size, st.st_mtime_ns): return cached[2]
+        digest = hash_file(fp)
+        self._digests[fp] = (st.st_size, st.st_mtime_ns, digest)
+        return digest
+
+    def _server_has(self, fn, fs, digest):
+        """Ask the server to fill `fn` from identical content it already stores."""
+        def operation(conn):
+            conn.sendall(CMD_HAVE + pack_string(fn) + struct.pack('!Q', fs) + digest)
+            return recv_exactly(conn, 2) == STATUS_OK
+        return self._request(operation)
+
+    # --- Stream helpers ---
+    def _transfer_codec(self, conn):
+        # Negotiated once per client on whichever connection asks first.
+        if not self.compression: return CODEC_NONE
+        if self._codec is None:
+            offered = supported_codecs()
+            conn.sendall(CMD_CODECS + bytes([len(offered)]) + bytes(offered))
+            self._codec = recv_exactly(conn, 1)[0]
+        return self._codec
+
+    def _chunks(self):
+        # Chunk sizes start at buffer_size and adapt to the link (see stream_io).
+        return ChunkSizer(self.buffer_size)
+
+    def _counter(self, done, progress, total):
+        # Turns per-chunk byte counts into progress(done, total) calls.
+        state = [done]
+
+        def on_chunk(n):
+            state[0] += n
+            if progress: progress(state[0], total)
+        return on_chunk
+
+    def _send_file(self, conn, f, start, end, codec, progress, total):
+        """Send bytes [start, end) of `f`, as compression frames when `codec` is set."""
+        if codec == CODEC_NONE:
+            send_from_file(conn, f, start, end - start, self._chunks(), self._counter(start, progress, total))
+            return
+        f.seek(start)
+        encoder = FrameEncoder(codec)
+
+        def next_frame(size):
+            raw = f.read(size)
+            if len(raw) != size: raise OSError("File shrank while uploading.")
+            return encoder.encode(raw)
+
+        # Frame n + 1 is read and compressed on a worker thread while frame n is sent.
+        sizes = [min(FRAME_SIZE, end - pos) for pos in range(start, end, FRAME_SIZE)]
+        with ThreadPoolExecutor(max_workers=1) as worker:
+            pending = worker.submit(next_frame, sizes[0]) if sizes else None
+            sent = start
+            for i, size in enumerate(sizes):
+                header, payload = pending.result()
+                if i + 1 < len(sizes): pending = worker.submit(next_frame, sizes[i + 1])
+                conn.sendall(header)
+                conn.sendall(payload)
+                sent += size
+                if progress: progress(sent, total)
+
+    def _receive_file(self, conn, f, start, end, codec, progress, total, digest=None):
+        """Receive bytes [start, end) into `f` at its current position, feeding them to `digest`."""
+        if codec == CODEC_NONE:
+            receive_into_file(conn, f, end - start, self._chunks(), self._counter(start, progress, total), digest)
+            return
+        rec = start
+
+        def write_frame(flag, raw_len, payload):
+            data = decode_frame(codec, flag, raw_len, payload)
+            f.write(data)
+            if digest: digest.update(data)
+
+        # Frame n is decompressed and written on a worker thread while frame n + 1 arrives.
+        with ThreadPoolExecutor(max_workers=1) as worker:
+            pending = None
+            while rec < end:
+                flag, raw_len, wire_len = read_frame_header(recv_exactly(conn, 9))
+                if rec + raw_len > end: raise ValueError("Compressed stream overruns its range")
+                payload = recv_exactly(conn, wire_len)
+                if pending: pending.result()
+                pending = worker.submit(write_frame, flag, raw_len, payload)
+                rec += raw_len
+                if progress: progress(rec, total)
+            if pending: pending.result()
+
+    # --- Striping helpers ---
+    def _should_stripe(self, fs):
+        return self.streams > 1 and fs >= self.stripe_threshold
+
+    def _stripes(self, fs):
+        step = -(-fs // self.streams)
+        return [[start, min(start + step, fs), 0] for start in range(0, fs, step)]
+
+    def _run_stripes(self, stripes, transfer, progress, total):
+        # Each [start, end, done] stripe runs as transfer(conn, stripe, advance) on its own
+        # pooled connection; advance() keeps the stripe and the overall progress in step.
+        lock = threading.Lock()
+        done = [sum(stripe[2] for stripe in stripes)]
+
+        def advance(stripe, n):
+            with lock:
+                stripe[2] += n
+                done[0] += n
+                if progress: progress(done[0], total)
+
+        pending = [stripe for stripe in stripes if stripe[0] + stripe[2] < stripe[1]]
+        with ThreadPoolExecutor(max_workers=max(1, len(pending))) as executor:
+            futures = [executor.submit(self._request, functools.partial(transfer, stripe=stripe, advance=advance))
+                       for stripe in pending]
+            return [future.result() for future in futures]
+
+    def remote_size(self, fn):
+        def operation(conn):
+            conn.sendall(CMD_DOWNLOAD + pack_string(fn) + struct.pack('!QQB', END_OF_FILE, 0, CODEC_NONE))
+            if recv_exactly(conn, 2) == STATUS_NOT_FOUND: return None
+            # An empty range: the header, no data and the trailing digest.
+            return struct.unpack('!QQ', recv_exactly(conn, 16 + 2 * DIGEST_SIZE)[:16])[0]
+        return self._request(operation)
+
+    # --- Uploads ---
+    def upload(self, fp, progress=None):
+        """Upload `fp`, continuing from whatever part of it the server already holds."""
+        fn, fs = os.path.basename(fp), os.path.getsize(fp)
+        digest = self._local_digest(fp)
+        if self._server_has(fn, fs, digest):
+            if progress: progress(fs, fs)
+            return True
+        if self.delta_sync and fs:
+            result = self._upload_delta(fp, fs, digest, progress)
+            if result is not None: return result
+        if self._should_stripe(fs): return self._upload_striped(fp, fs, progress)
+
+        def operation(conn):
+            conn.sendall(CMD_RESUME + pack_string(fn))
+            offset, held = struct.unpack(f'!Q{DIGEST_SIZE}s', recv_exactly(conn, 8 + DIGEST_SIZE))
+            # The server's bytes may be from another version of the file; only a matching prefix resumes.
+            if offset > fs or (offset and bytes(held) != hash_file(fp, length=offset)): offset = 0
+            codec = self._transfer_codec(conn)
+            conn.sendall(CMD_UPLOAD + pack_string(fn) + struct.pack('!QQQB', fs, offset, fs - offset, codec) + digest)
+            with open(fp, 'rb') as f:
+                self._send_file(conn, f, offset, fs, codec, progress, fs)
+            return recv_exactly(conn, 2) == STATUS_OK
+        return self._request(operation)
+
+    def _upload_delta(self, fp, fs, digest, progress):
+        """Send only what changed against the server's copy; None if it has no copy."""
+        fn = os.path.basename(fp)
+        literal_chunk = max(self.buffer_size, 64 * 1024)
+
+        def operation(conn):
+            conn.sendall(CMD_SIGNATURES + pack_string(fn) + struct.pack('!I', 0))
+            if recv_exactly(conn, 2) == STATUS_NOT_FOUND: return None
+            basis_size, block_size, count = struct.unpack('!QII', recv_exactly(conn, 16))
+            signatures = unpack_signatures(recv_exactly(conn, count * SIGNATURE_SIZE))
+            conn.sendall(CMD_DELTA + pack_string(fn) + struct.pack('!QI', fs, block_size))
+            with open(fp, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if len(data) != fs: raise OSError(f"{fn} changed while uploading.")
+                run = None  # consecutive block references go out as one (first, count) op
+
+                def flush_run():
+                    if run: conn.sendall(OP_BLOCKS + struct.pack('!II', *run))
+
+                for op, a, b in compute_delta(data, signatures, block_size, basis_size):
+                    if op == OP_BLOCKS:
+                        if run and run[0] + run[1] == a:
+                            run[1] += 1
+                        else:
+                            flush_run()
+                            run = [a, 1]
+                    else:
+                        flush_run()
+                        run = None
+                        for start in range(a, b, literal_chunk):
+                            piece = data[start:min(start + literal_chunk, b)]
+                            conn.sendall(OP_LITERAL + struct.pack('!I', len(piece)) + piece)
+                    if progress: progress(b, fs)
+                flush_run()
+                conn.sendall(OP_END + digest)
+            if progress: progress(fs, fs)
+            return recv_exactly(conn, 2) == STATUS_OK
+        return self._request(operation)
+
+    def _upload_striped(self, fp, fs, progress):
+        # The token names this version of the file, so a retry (or a restarted client) finds
+        # the stripes the server has already verified and sends only the rest.
+        fn = os.path.basename(fp)
+        token = hashlib.sha256(f"{fn}\0{fs}\0{os.stat(fp).st_mtime_ns}".encode('utf-8')).hexdigest()[:32]
+
+        def verified(conn):
+            conn.sendall(CMD_STRIPES + pack_string(fn) + pack_string(token))
+            count = struct.unpack('!I', recv_exactly(conn, 4))[0]
+            data = recv_exactly(conn, 16 * count)
+            return {struct.unpack_from('!QQ', data, 16 * i) for i in range(count)}
+
+        def transfer(conn, stripe, advance):
+            # The server may have dropped the tail of a failed attempt, so a retry resends the whole stripe.
+            advance(stripe, -stripe[2])
+            start, end, _ = stripe
+            conn.sendall(CMD_PART + pack_string(fn) + pack_string(token) + struct.pack('!QQQ', fs, start, end - start))
+            # The stripe's SHA-256 follows it; a second thread hashes it while it is sent.
+            with ThreadPoolExecutor(max_workers=1) as worker, open(fp, 'rb') as f:
+                hashing = worker.submit(hash_file, fp, 1024 * 1024, end - start, start)
+                send_from_file(conn, f, start, end - start, self._chunks(), lambda n: advance(stripe, n))
+                conn.sendall(hashing.result())
+            return recv_exactly(conn, 2) == STATUS_OK
+
+        def finish(conn, command):
+            size = struct.pack('!Q', fs) if command == CMD_COMMIT else b''
+            conn.sendall(command + pack_string(fn) + pack_string(token) + size)
+            return recv_exactly(conn, 2) == STATUS_OK
+
+        stripes, held = self._stripes(fs), self._request(verified)
+        for stripe in stripes:
+            if (stripe[0], stripe[1] - stripe[0]) in held: stripe[2] = stripe[1] - stripe[0]
+        try:
+            sent = all(self._run_stripes(stripes, transfer, progress, fs))
+        except OSError:
+            raise  # a network error: the verified stripes stay staged for the retry
+        except BaseException:
+            try:
+                self._request(functools.partial(finish, command=CMD_ABORT))
+            except Exception:
+                pass
+            raise
+        return sent and self._request(functools.partial(finish, command=CMD_COMMIT))
+
+    # --- Downloads ---
+    def download(self, fn, dest_dir, progress=None):
+        """Download `fn` into `dest_dir`, resuming a leftover .part file; returns the local
+        path, or None if the server lacks the file."""
+        fp = os.path.join(dest_dir, os.path.basename(fn))
+        part = fp + PARTIAL_SUFFIX
+        if self.streams > 1:
+            fs = self.remote_size(fn)
+            if fs is None: return None
+            if self._should_stripe(fs): return self._download_striped(fn, fp, fs, progress)
+        if os.path.exists(part + STRIPES_SUFFIX):
+            # A preallocated striped .part is not a contiguous prefix, so it can't seed a sequential resume.
+            os.remove(part + STRIPES_SUFFIX)
+            if os.path.exists(part): os.remove(part)
+
+        def request_range(conn, offset, codec):
+            conn.sendall(CMD_DOWNLOAD + pack_string(fn) + struct.pack('!QQB', offset, 0, codec))
+            status = recv_exactly(conn, 2)
+            if status == STATUS_NOT_FOUND: return None
+            if status != STATUS_OK: raise OSError(f"Server refused to send {fn}.")
+            return struct.unpack(f'!QQ{DIGEST_SIZE}s', recv_exactly(conn, 16 + DIGEST_SIZE))[0]
+
+        def operation(conn):
+            codec = self._transfer_codec(conn)
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            fs = request_range(conn, offset, codec)
+            if fs is None: return None
+            if offset > fs:  # leftover from a different version of the file
+                recv_exactly(conn, DIGEST_SIZE)  # trailer of the empty reply
+                offset = 0
+                fs = request_range(conn, 0, codec)
+                if fs is None: return None
+            # The received bytes are hashed on the fly; only a resumed prefix is read back.
+            digest = hash_prefix(part, length=offset) if offset else hashlib.sha256()
+            with open(part, 'r+b' if offset else 'wb') as f:
+                f.seek(offset)
+                f.truncate()
+                self._receive_file(conn, f, offset, fs, codec, progress, fs, digest)
+            expected = recv_exactly(conn, DIGEST_SIZE)
+            if expected != NO_DIGEST and digest.digest() != expected:
+                os.remove(part)
+                raise OSError(f"{fn} is corrupt (SHA-256 mismatch); download it again.")
+            os.replace(part, fp)
+            return fp
+        return self._request(operation)
+
+    def _load_stripes(self, part, fs):
+        try:
+            with open(part + STRIPES_SUFFIX) as f:
+                state = json.load(f)
+            if state['size'] == fs and os.path.getsize(part) == fs: return state['stripes']
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def _download_striped(self, fn, fp, fs, progress):
+        # Stripes are written in place into a .part preallocated to the full size; if any of
+        # them fails, their progress is saved so the next attempt only fetches what is missing.
+        part = fp + PARTIAL_SUFFIX
+        stripes = self._load_stripes(part, fs)
+        if stripes is None:
+            stripes = self._stripes(fs)
+            with open(part, 'wb') as f: preallocate(f, fs)
+
+        versions = set()  # whole-file digests the server reported, to notice the file changing
+
+        def fetch(conn, stripe, advance, offset, count):
+            # One range of the stripe, hashed as it arrives and checked against the SHA-256 the
+            # server sends after a range asked for by length. A range that fails is taken back.
+            conn.sendall(CMD_DOWNLOAD + pack_string(fn) + struct.pack('!QQB', offset, count, CODEC_NONE))
+            if recv_exactly(conn, 2) == STATUS_NOT_FOUND: raise FileNotFoundError(f"{fn} vanished from the server.")
+            remote_size, sent, version = struct.unpack(f'!QQ{DIGEST_SIZE}s', recv_exactly(conn, 16 + DIGEST_SIZE))
+            if version != NO_DIGEST: versions.add(version)
+            if remote_size != fs or sent != count or len(versions) > 1: raise OSError(f"{fn} changed on the server.")
+            digest, received = hashlib.sha256(), [0]
+
+            def on_chunk(n):
+                received[0] += n
+                advance(stripe, n)
+
+            try:
+                with open(part, 'r+b') as f:
+                    f.seek(offset)
+                    receive_into_file(conn, f, count, self._chunks(), on_chunk, digest)
+                expected = bytes(recv_exactly(conn, DIGEST_SIZE))
+                if expected != NO_DIGEST and expected != digest.digest():
+                    raise OSError(f"{fn} arrived corrupt (SHA-256 mismatch); download it again.")
+            except BaseException:
+                advance(stripe, -received[0])
+                raise
+
+        def transfer(conn, stripe, advance):
+            start, end, _ = stripe
+            while start + stripe[2] < end:
+                offset = start + stripe[2]
+                fetch(conn, stripe, advance, offset, min(end - offset, STRIPE_REQUEST_SIZE))
+
+        try:
+            self._run_stripes(stripes, transfer, progress, fs)
+        except BaseException:
+            with open(part + STRIPES_SUFFIX, 'w') as f: json.dump({'size': fs, 'stripes': stripes}, f)
+            raise
+        os.replace(part, fp)
+        if os.path.exists(part + STRIPES_SUFFIX): os.remove(part + STRIPES_SUFFIX)
+        return fp
+
+    # --- Batches ---
+    def upload_batch(self, paths, progress=None):
+        """Upload files and whole directory trees over one connection without a round trip
+        per file; returns (stored count, names the server failed to store)."""
+        files = [(fp, name, os.path.getsize(fp)) for fp, name in expand_paths(paths)]
+        total = sum(size for _, _, size in files)
+
+        def operation(conn):
+            conn.sendall(CMD_BATCH_UPLOAD)
+            out, done = bytearray(), 0
+            for fp, name, size in files:
+                with open(fp, 'rb') as f:
+                    out += pack_string(name) + struct.pack('!Q', size)
+                    digest = hashlib.sha256()
+                    remaining = size
+                    while remaining:
+                        data = f.read(min(max(self.buffer_size, BATCH_SEND_SIZE), remaining))
+                        if not data: raise OSError(f"{name} shrank while uploading.")
+                        out += data
+                        digest.update(data)
+                        remaining -= len(data)
+                        done += len(data)
+                        if len(out) >= BATCH_SEND_SIZE:
+                            conn.sendall(out)
+                            out.clear()
+                            if progress: progress(done, total)
+                    out += digest.digest()
+            conn.sendall(out + pack_string(''))
+            if progress: progress(total, total)
+            stored, failed = struct.unpack('!II', recv_exactly(conn, 8))
+            return stored, [recv_string(conn) for _ in range(failed)]
+        return self._request(operation)
+
+    def download_batch(self, names, dest_dir, progress=None):
+        """Download files (or whole remote directories) over one connection, keeping their
+        relative paths under `dest_dir`; returns (local paths, names the server lacks or
+        that arrived corrupt)."""
+        def operation(conn):
+            conn.sendall(CMD_BATCH_DOWNLOAD + struct.pack('!I', len(names)) + b''.join(pack_string(n) for n in names))
+            _, total = struct.unpack('!IQ', recv_exactly(conn, 12))
+            saved, missing = [], []
+            chunks, on_chunk = self._chunks(), self._counter(0, progress if total else None, total)
+            while True:
+                name = recv_string(conn)
+                if not name: break
+                if not recv_exactly(conn, 1)[0]:
+                    missing.append(name)
+                    continue
+                size = struct.unpack('!Q', recv_exactly(conn, 8))[0]
+                fp = os.path.join(dest_dir, *split_relpath(name))
+                os.makedirs(os.path.dirname(fp), exist_ok=True)
+                digest = hashlib.sha256()
+                with open(fp + PARTIAL_SUFFIX, 'wb') as f:
+                    receive_into_file(conn, f, size, chunks, on_chunk, digest)
+                expected = recv_exactly(conn, DIGEST_SIZE)
+                if expected != NO_DIGEST and digest.digest() != expected:
+                    os.remove(fp + PARTIAL_SUFFIX)
+                    missing.append(name)
+                    continue
+                os.replace(fp + PARTIAL_SUFFIX, fp)
+                saved.append(fp)
+            return saved, missing
+        return self._request(operation)
@@ -0,0 +1,230 @@
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from protocol import split_relpath
+
+# Item states.
+QUEUED = 'queued'
+RUNNING = 'running'
+RETRYING = 'retrying'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+UPLOAD = 'upload'
+UPLOAD_BATCH = 'upload_batch'
+DOWNLOAD = 'download'
+DOWNLOAD_BATCH = 'download_batch'
+
+# Of several files queued together, those smaller than this go as one batch item over one
+# pipelined connection; larger ones get an item each, so they can resume and stripe.
+BATCH_FILE_LIMIT = 8 * 1024 * 1024
+
+
+class TransferCancelled(Exception):
+    """Raised from a transfer's progress callback to stop it."""
+
+
+class TransferItem:
+    """One queued upload or download and how far it has got. The manager's worker threads
+    update it in place; readers only look."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, kind, source, label):
+        self.id = next(TransferItem._ids)
+        self.kind = kind  # UPLOAD, UPLOAD_BATCH, DOWNLOAD or DOWNLOAD_BATCH
+        self.source = source  # local path for uploads, remote name for downloads; a list of them for batches
+        self.label = label
+        self.state = QUEUED
+        self.done = 0
+        self.total = 0
+        self.attempts = 0
+        self.error = None
+        self.result = None  # local path of a finished download, local paths of a finished batch
+        self.started = None
+        self._cancel = threading.Event()
+
+    @property
+    def finished(self):
+        return self.state in (DONE, FAILED, CANCELLED)
+
+    @property
+    def is_download(self):
+        return self.kind in (DOWNLOAD, DOWNLOAD_BATCH)
+
+    @property
+    def rate(self):
+        # Average bytes/s of the current attempt.
+        if self.state != RUNNING or not self.started: return 0.0
+        return self.done / max(time.monotonic() - self.started, 1e-6)
+
+
+def _small_file(path):
+    try:
+        return os.path.getsize(path) < BATCH_FILE_LIMIT
+    except OSError:
+        return False  # queued on its own, to fail there with its own error
+
+
+def _batch_label(labels):
+    return labels[0] if len(labels) == 1 else f"{labels[0]} and {len(labels) - 1} more"
+
+
+# --- Client-side transfer queue ---
+class TransferManager:
+    """Runs queued uploads and downloads `concurrency` at a time on worker threads.
+
+    `get_client()` returns the TransferClient to use and is called as each item starts.
+    `on_update(item)` is called from the worker threads when an item changes state, and
+    at most every `progress_interval` seconds while it moves data. A transfer that fails
+    with a network error is retried up to `retries` times after a growing delay, picking up
+    where the last attempt stopped: from .part files, or for striped uploads from the stripes
+    the server already verified (batch items start over: they are made of small files). Downloads keep their remote directories
+    under `dest_dir`.
+    """
+
+    def __init__(self, get_client, dest_dir, concurrency=3, retries=2, retry_delay=2.0, on_update=None,
+                 progress_interval=0.25):
+        self.get_client = get_client
+        self.dest_dir = dest_dir
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.on_update = on_update
+        self.progress_interval = progress_interval
+        self.items = {}  # id -> TransferItem, in the order queued
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max(1, concurrency), thread_name_prefix='transfer')
+
+    # --- Queueing ---
+    def upload(self, paths):
+        """Queue local files and directories; returns the items. Directories, and of several
+        files the small ones (see BATCH_FILE_LIMIT), go together as one batch item."""
+        paths = [os.path.abspath(path) for path in paths]
+        batch = [path for path in paths if os.path.isdir(path) or (len(paths) > 1 and _small_file(path))]
+        if len(batch) == 1 and not os.path.isdir(batch[0]): batch = []
+        labels = [os.path.basename(path) + ('/' if os.path.isdir(path) else '') for path in batch]
+        items = [TransferItem(UPLOAD_BATCH, batch, _batch_label(labels))] if batch else []
+        batched = set(batch)
+        items += [TransferItem(UPLOAD, path, os.path.basename(path)) for path in paths if path not in batched]
+        for item in items: self._submit(item)
+        return items
+
+    def download(self, names, sizes=None):
+        """Queue remote files by name; returns the items. Of several names, those smaller than
+        BATCH_FILE_LIMIT by `sizes` (name -> bytes, unknown sizes count as small) go together
+        as one batch item."""
+        sizes = sizes or {}
+        batch = [name for name in names if len(names) > 1 and sizes.get(name, 0) < BATCH_FILE_LIMIT]
+        if len(batch) == 1: batch = []
+        items = [TransferItem(DOWNLOAD_BATCH, batch, _batch_label(batch))] if batch else []
+        batched = set(batch)
+        items += [TransferItem(DOWNLOAD, name, name) for name in names if name not in batched]
+        for item in items: self._submit(item)
+        return items
+
+    def cancel(self, item_id):
+        """Cancel a queued item at once, or a running one at its next progress report."""
+        item = self.items.get(item_id)
+        if item is None or item.finished: return
+        item._cancel.set()
+        if item.state == QUEUED: self._finish(item, CANCELLED)
+
+    def retry(self, item_id):
+        """Queue a failed or cancelled item again."""
+        item = self.items.get(item_id)
+        if item is None or item.state not in (FAILED, CANCELLED): return
+        item._cancel = threading.Event()
+        item.attempts = 0
+        item.error = None
+        self._submit(item)
+
+    def clear_finished(self):
+        """Forget finished items; returns their ids."""
+        with self._lock:
+            ids = [item_id for item_id, item in self.items.items() if item.finished]
+            for item_id in ids: del self.items[item_id]
+        return ids
+
+    @property
+    def pending(self):
+        return sum(1 for item in list(self.items.values()) if not item.finished)
+
+    def close(self):
+        """Cancel everything queued or running and stop the workers."""
+        for item_id in list(self.items): self.cancel(item_id)
+        self._executor.shutdown(wait=False)
+
+    def _submit(self, item):
+        with self._lock: self.items[item.id] = item
+        item.state = QUEUED
+        self._notify(item)
+        self._executor.submit(self._run, item)
+
+    def _notify(self, item):
+        if self.on_update: self.on_update(item)
+
+    def _finish(self, item, state, error=None):
+        item.state = state
+        item.error = error
+        self._notify(item)
+
+    # --- Workers ---
+    def _run(self, item):
+        if item._cancel.is_set(): return  # cancelled while queued
+        while True:
+            item.attempts += 1
+            item.state = RUNNING
+            item.started = time.monotonic()
+            self._notify(item)
+            try:
+                self._transfer(item)
+            except TransferCancelled:
+                self._finish(item, CANCELLED)
+            except OSError as e:
+                if item._cancel.is_set():
+                    self._finish(item, CANCELLED)
+                elif item.attempts > self.retries:
+                    self._finish(item, FAILED, str(e))
+                else:
+                    self._finish(item, RETRYING, str(e))
+                    if item._cancel.wait(self.retry_delay * item.attempts):
+                        self._finish(item, CANCELLED)
+                    else:
+                        continue
+            except Exception as e:
+                self._finish(item, FAILED, str(e))
+            else:
+                self._finish(item, DONE)
+            return
+
+    def _transfer(self, item):
+        client = self.get_client()
+        last = [0.0]
+
+        def progress(done, total):
+            if item._cancel.is_set(): raise TransferCancelled()
+            item.done, item.total = done, total
+            now = time.monotonic()
+            if now - last[0] >= self.progress_interval:
+                last[0] = now
+                self._notify(item)
+
+        if item.kind == UPLOAD:
+            item.total = os.path.getsize(item.source)
+            if not client.upload(item.source, progress): raise OSError("The server did not store the file.")
+        elif item.kind == UPLOAD_BATCH:
+            _, failed = client.upload_batch(item.source, progress)
+            if failed: raise OSError(f"The server did not store {len(failed)} file(s), e.g. {failed[0]}.")
+        elif item.kind == DOWNLOAD_BATCH:
+            item.result, missing = client.download_batch(item.source, self.dest_dir, progress)
+            if missing: raise ValueError(f"{len(missing)} file(s) missing on the server or damaged, e.g. {missing[0]}.")
+        else:
+            dest = os.path.join(self.dest_dir, *split_relpath(item.source)[:-1])
+            os.makedirs(dest, exist_ok=True)
+            item.result = client.download(item.source, dest, progress)
+            if item.result is None: raise ValueError("Not found on the server.")
+        item.done = item.total